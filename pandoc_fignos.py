@@ -28,8 +28,8 @@ __version__ = '2.4.0'
 #
 #   1. Insert text for the figure number in each figure caption.
 #      For LaTeX, insert \label{...} instead.  The figure ids
-#      and associated figure numbers are stored in the global
-#      target tracker.
+#      and associated figure numbers are stored in the
+#      filter's target tracker.
 #
 #   2. Replace each reference with a figure number.  For LaTeX,
 #      replace with \ref{...} instead.
@@ -40,19 +40,24 @@ __version__ = '2.4.0'
 
 # pylint: disable=invalid-name
 
+# Modules that are only needed for some documents or modes (argparse,
+# tempfile, textwrap, uuid, urllib, socket, ...) are imported where they are
+# used, to keep the startup time down.
+
+import os
 import sys
 import re
-import functools
-import argparse
 import json
-import copy
-import textwrap
-import uuid
+import marshal
+import contextlib
+import collections
+import io
+import threading
+import time
 
-from pandocfilters import walk
 from pandocfilters import Image, Div
-from pandocfilters import Math, Str, Space, Para, RawBlock, RawInline
-from pandocfilters import Span
+from pandocfilters import Math, Str, Para, Plain, RawBlock, RawInline
+from pandocfilters import Span, stringify
 
 import pandocxnos
 from pandocxnos import PandocAttributes
@@ -64,250 +69,1406 @@ from pandocxnos import attach_attrs_factory, detach_attrs_factory
 from pandocxnos import insert_secnos_factory, delete_secnos_factory
 from pandocxnos import version
 
-if sys.version_info > (3,):
-    from urllib.request import unquote
-else:
-    from urllib import unquote  # pylint: disable=no-name-in-module
-
 # Compiled regular expression for matching labels
 LABEL_PATTERN = re.compile(r'(fig:[\w/-]*)')
 
-# Meta variables; may be reset elsewhere
-captionname = 'Figure'  # The caption name
-separator = 'colon'     # The caption separator
-cleveref = False        # Flags that clever references should be used
-capitalise = False      # Flags that plusname should be capitalised
-plusname = ['fig.', 'figs.']      # Sets names for mid-sentence references
-starname = ['Figure', 'Figures']  # Sets names for references at sentence start
-numbersections = False  # Flags that figures should be numbered by section
-secoffset = 0           # Section number offset
-warninglevel = 2        # 0 - no warnings; 1 - some warnings; 2 - all warnings
-
-# Processing state variables
-cursec = None  # Current section
-Ntargets = 0   # Number of targets in current section (or document)
-targets = {}   # Global targets tracker
-
-# Processing flags
-captionname_changed = False     # Flags the caption name changed
-separator_changed = False       # Flags the caption separator changed
-plusname_changed = False        # Flags that the plus name changed
-starname_changed = False        # Flags that the star name changed
-has_unnumbered_figures = False  # Flags unnumbered figures were found
-has_tagged_figures = False      # Flags a tagged figure was found
-
-PANDOCVERSION = None
 
+# Walk -----------------------------------------------------------------------
 
-# Actions --------------------------------------------------------------------
+def walk(x, action, fmt, meta, post=None):
+    """Walks the element tree `x`, applying `action` to every element.
+    Returns `x`, modified in place.
 
-def _extract_attrs(x, n):
-    """Extracts attributes for an image in the element list `x`.  The
-    attributes begin at index `n`.  Extracted elements are deleted
-    from the list.
+    This follows pandocfilters.walk(): an action returns None to leave an
+    element unchanged, an element to replace it, or a list of elements to
+    splice into the enclosing list.  Returned elements are walked, but
+    the action is not applied to them.  An optional `post` action is
+    applied to each element after its contents have been walked; its
+    return value is ignored and so changes must be made in place.
+
+    Unlike pandocfilters.walk(), the tree is edited in place rather than
+    copied, and an explicit stack is used instead of recursion so that
+    deeply nested documents may be processed.
     """
-    try:  #  Try the standard call from pandocxnos first
-        return extract_attrs(x, n)
-
-    except (ValueError, IndexError):
-
-        if version(PANDOCVERSION) < version('1.16'):
-            # Look for attributes attached to the image path, as occurs with
-            # image references for pandoc < 1.16 (pandoc-fignos Issue #14).
-            # See http://pandoc.org/MANUAL.html#images for the syntax.
-            # Note: This code does not handle the "optional title" for
-            # image references (search for link_attributes in pandoc's docs).
-            assert x[n-1]['t'] == 'Image'
-            image = x[n-1]
-            s = image['c'][-1][0]
-            if '%20%7B' in s:
-                path = s[:s.index('%20%7B')]
-                attrstr = unquote(s[s.index('%7B'):])
-                image['c'][-1][0] = path  # Remove attr string from the path
-                return PandocAttributes(attrstr.strip(), 'markdown')
-        raise
-
-
-def _process_figure(key, value, fmt):
-    """Processes a figure.  Returns a dict containing figure properties.
 
-    Parameters:
+    # Each frame holds a list of items, the index of the next item, the
+    # index before which the action is skipped (None to always skip it), and
+    # the element whose contents are being walked (for the post action).
+    stack = [[x, 0, 0, None]] if isinstance(x, list) else \
+      [[list(x.values()), 0, None, None]] if isinstance(x, dict) else []
+
+    while stack:
+        frame = stack[-1]
+        items, i, start = frame[0], frame[1], frame[2]
+
+        if i == len(items):  # Done with this frame
+            stack.pop()
+            el = frame[3]
+            if post is not None and el is not None:
+                post(el['t'], el['c'] if 'c' in el else None, fmt, meta)
+            continue
+
+        item = items[i]
+        frame[1] = i + 1
+
+        is_element = isinstance(item, dict) and 't' in item
+        if is_element and start is not None and i >= start:
+            res = action(item['t'], item['c'] if 'c' in item else None,
+                         fmt, meta)
+            if isinstance(res, list):  # Splice and revisit without action
+                items[i:i+1] = res
+                frame[1], frame[2] = i, i + len(res)
+                continue
+            if res is not None:
+                items[i] = item = res
+                is_element = isinstance(item, dict) and 't' in item
+
+        if isinstance(item, list):
+            stack.append([item, 0, 0, None])
+        elif isinstance(item, dict):
+            stack.append([list(item.values()), 0, None,
+                          item if is_element and start is not None else None])
+
+    return x
+
+
+# Index ----------------------------------------------------------------------
+
+# Element types that cannot contain other elements
+LEAF_TYPES = frozenset(['Str', 'Space', 'SoftBreak', 'LineBreak', 'Math',
+                        'Code', 'RawInline', 'CodeBlock', 'RawBlock',
+                        'HorizontalRule', 'Null'])
+
+# Block element types
+BLOCK_TYPES = frozenset(['Plain', 'Para', 'LineBlock', 'CodeBlock',
+                         'RawBlock', 'BlockQuote', 'OrderedList',
+                         'BulletList', 'DefinitionList', 'Header',
+                         'HorizontalRule', 'Table', 'Figure', 'Div',
+                         'Null'])
+
+def index_document(x, links=False):
+    """Scans the element tree `x` and returns an index of the elements that
+    the passes act on.  The index is a dict with the following fields:
+
+      figures - (path, parent, element) entries for Headers, Divs with
+                figure labels, Figures, and Para/Plain elements that contain
+                Images, followed by those Images
+      refs - (path, element) entries for the innermost blocks that
+             contain Cite elements with figure labels, Spans or (if `links`
+             is True) Links that may be parts of broken references
+
+    A path is a tuple of the list indices and dict keys leading from `x` to
+    the element; the parent is the list that holds the element.  The
+    entries are in document order and refs blocks do not nest.
+    """
 
-      key - 'Para' (for a normal figure) or 'Div'
-      value - the content of the figure
-      fmt - the output format ('tex', 'html', ...)
+    figures = []
+    refs = []
+
+    # Each stack entry holds an item, its path, the list that holds it, and
+    # the innermost block (and its path) that encloses it
+    stack = [(x, (), None, None)]
+    while stack:
+        item, path, parent, block = stack.pop()
+
+        if isinstance(item, list):
+            for i in range(len(item)-1, -1, -1):
+                v = item[i]
+                if isinstance(v, list) or \
+                  (isinstance(v, dict) and v.get('t') not in LEAF_TYPES):
+                    stack.append((v, path + (i,), item, block))
+            continue
+
+        key = item.get('t')
+        if key is None:  # Not an element; e.g. a citation
+            for k in sorted(item, reverse=True):
+                if isinstance(item[k], (list, dict)):
+                    stack.append((item[k], path + (k,), item, block))
+            continue
+
+        value = item.get('c')
+        if key in BLOCK_TYPES:
+            block = (path, item)
+            if key == 'Header':
+                figures.append((path, parent, item))
+            elif key in ['Para', 'Plain']:
+                images = [(path + ('c', i), value, v) \
+                          for i, v in enumerate(value) if v['t'] == 'Image']
+                if images:
+                    figures.append((path, parent, item))
+                    figures.extend(images)
+            elif key == 'Div' and LABEL_PATTERN.match(value[0][0]):
+                figures.append((path, parent, item))
+            elif key == 'Figure':
+                figures.append((path, parent, item))
+        elif key == 'Cite':
+            if block and any(citation['citationId'].startswith('fig:')
+                             for citation in value[-2]):
+                refs.append(block)
+        elif key == 'Span' or (links and key == 'Link'):
+            if block:
+                refs.append(block)
+
+        if isinstance(value, (list, dict)):
+            stack.append((value, path + ('c',), parent, block))
+
+    # Order the refs blocks and remove those that are enclosed by others
+    ret = []
+    for path, el in sorted(refs, key=lambda entry: entry[0]):
+        if not ret or ret[-1][0] != path[:len(ret[-1][0])]:
+            ret.append((path, el))
+
+    return {'figures': figures, 'refs': ret}
+
+def apply_first_pass(entries, first_pass, fmt, meta):
+    """Applies the `first_pass` action to the elements of the indexed
+    `entries`.  Lists returned by the action are spliced into the document
+    once all of the entries have been visited, so that the entries remain
+    valid in the meantime."""
+    splices = []
+    for path, parent, el in entries:
+        ret = first_pass(el['t'], el['c'] if 'c' in el else None, fmt, meta)
+        if ret is not None:
+            splices.append((path[-1], parent, el, ret))
+    for i, parent, el, ret in reversed(splices):
+        if parent[i] is not el:  # The parent list was changed
+            i = next(j for j, v in enumerate(parent) if v is el)
+        if isinstance(ret, list):
+            parent[i:i+1] = ret
+        else:
+            parent[i] = ret
+
+
+# Version detection ----------------------------------------------------------
+
+# The detected pandoc versions, by executable path, as loaded from the
+# version cache file
+_VERSIONS = {}
+
+def version_cache_path():
+    """Returns the path of the pandoc version cache file, or None if the
+    cache is disabled.  The path may be set (or set empty to disable the
+    cache) with the FIGNOS_VERSION_CACHE environment variable."""
+    if 'FIGNOS_VERSION_CACHE' in os.environ:
+        return os.environ['FIGNOS_VERSION_CACHE'] or None
+    cachedir = os.environ.get('XDG_CACHE_HOME') or \
+      os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cachedir, 'pandoc-fignos', 'pandoc-versions.json')
+
+def _pandoc_executable():
+    """Returns the path of the pandoc executable that pandocxnos would ask
+    for its version, or None if it cannot be found."""
+    import psutil
+    try:  # The parent process, as for pandocxnos
+        parent = psutil.Process(os.getpid()).parent()
+        command = (parent.parent() if os.name == 'nt' else parent).exe()
+        if not os.path.basename(command).startswith('pandoc'):
+            raise RuntimeError('pandoc not found')
+    except Exception:  # pylint: disable=broad-except
+        command = 'pandoc'
+    if os.path.isabs(command):
+        return command
+    for dirpath in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(dirpath, command)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def detect_pandoc_version(pandocversion=None, doc=None, verbose=False):
+    """Returns the pandoc version, using the version cache to avoid
+    running pandoc where possible.
+
+    pandocxnos runs `pandoc -v` to get the version when it is not given,
+    is not in the PANDOC_VERSION environment variable, and cannot be
+    inferred from the document `doc`.  In that case the version is looked
+    up in the cache by the path, size and modification time of the pandoc
+    executable.  If it is not found, pandocxnos detects it and the cache
+    is updated.  Otherwise `pandocversion` is returned as is, for
+    pandocxnos to work out.  Cache hits and misses are reported to stderr
+    if `verbose` is True.
+    """
+    if pandocversion or 'PANDOC_VERSION' in os.environ or \
+      (doc is not None and 'pandoc-api-version' in doc):
+        return pandocversion
+    cachepath = version_cache_path()
+    executable = _pandoc_executable()
+    if cachepath is None or executable is None:
+        return pandocversion
+
+    # Look up the version
+    stat = os.stat(executable)
+    key = [stat.st_size, stat.st_mtime]
+    if not _VERSIONS and os.path.exists(cachepath):
+        try:
+            with io.open(cachepath, encoding='utf-8') as f:
+                _VERSIONS.update(json.load(f))
+        except (IOError, OSError, ValueError):  # Start the cache over
+            pass
+    entry = _VERSIONS.get(executable)
+    if entry and entry[:2] == key:
+        if verbose:
+            STDERR.write('pandoc-fignos: Pandoc version %s for %s (cached).\n'
+                         % (entry[2], executable))
+            STDERR.flush()
+        return entry[2]
+
+    # Detect the version and save it
+    with _XNOS_LOCK:
+        pandocversion = pandocxnos.init(None, doc)
+    _VERSIONS[executable] = key + [pandocversion]
+    if verbose:
+        STDERR.write('pandoc-fignos: Pandoc version %s for %s (%s).\n' % \
+                     (pandocversion, executable,
+                      'cache entry out of date' if entry else 'not cached'))
+        STDERR.flush()
+    try:
+        if not os.path.isdir(os.path.dirname(cachepath)):
+            os.makedirs(os.path.dirname(cachepath))
+        save_json(cachepath, _VERSIONS)
+    except (IOError, OSError):  # The cache is only an optimization
+        pass
+    return pandocversion
+
+# The latest pandoc version that pandocxnos knows.  pandocxnos is told that
+# later versions are this one; their references are written the same way.
+XNOS_PANDOCVERSION = '2.19'
+
+def init_pandocxnos(pandocversion=None, doc=None, verbose=False):
+    """Initializes pandocxnos for the document `doc` and returns the pandoc
+    version (see detect_pandoc_version()).
+
+    Pandoc >= 3.0 is recognized from `pandocversion`, the PANDOC_VERSION
+    environment variable or the pandoc-api-version (>= 1.23) of `doc`.
+    The pandoc version returned for it is not the one given to pandocxnos.
+    """
+    pandocversion = pandocversion or os.environ.get('PANDOC_VERSION')
+    if pandocversion:
+        if version(pandocversion) >= version('3.0'):
+            pandocxnos.init(XNOS_PANDOCVERSION, doc)
+            return pandocversion
+    elif isinstance(doc, dict) and \
+      doc.get('pandoc-api-version', [])[:2] >= [1, 23]:
+        pandocxnos.init(XNOS_PANDOCVERSION, doc)
+        return '3.0'
+    return pandocxnos.init(
+        detect_pandoc_version(pandocversion, doc, verbose), doc)
+
+
+# Configuration --------------------------------------------------------------
+
+# Output format families; see register_backend()
+FAMILIES = {}
+
+# Caption separators
+SEPARATORS = {'none':'', 'colon':':', 'period':'.', 'space':' ',
+              'quad':u'\u2000', 'newline':'\n'}
+
+# The settings for filtering a document.  These are computed once from the
+# output format, the pandoc version and the metadata, and are consulted by
+# the figure actions.
+Config = collections.namedtuple('Config', [
+    'fmt',             # The output format
+    'family',          # The format family ('latex', 'html', ... or None)
+    'pandocversion',   # The pandoc version
+    'image_attrs',     # Flags that Images have attributes (pandoc >= 1.16)
+    'native_labels',   # Flags that pandoc writes tex \labels (>= 1.17)
+    'api',             # Flags the pandoc-api-version doc layout (>= 1.18)
+    'figure_blocks',   # Flags that figures are Figure blocks (>= 3.0)
+    'caption_prefix',  # The caption name followed by a nonbreaking space
+    'sep',             # The caption separator string
+    'numbersections',  # Flags that figures are numbered by section
+    'tag_secnos',      # Flags that section numbers are written as tags
+    'secnos',          # Flags that section numbers are tracked
+    'secoffset'])      # Section number offset
+
+# pylint: disable=too-many-arguments
+def make_config(fmt, pandocversion, captionname='Figure', separator='colon',
+                numbersections=False, secoffset=0):
+    """Returns the Config for the output format `fmt`, the pandoc version
+    and the given meta variable values."""
+    family = FAMILIES.get(fmt)
+    epub = fmt in ['epub', 'epub2', 'epub3']
+    return Config(
+        fmt=fmt, family=family, pandocversion=pandocversion,
+        image_attrs=version(pandocversion) >= version('1.16'),
+        native_labels=version(pandocversion) >= version('1.17'),
+        api=version(pandocversion) >= version('1.18'),
+        figure_blocks=version(pandocversion) >= version('3.0'),
+        caption_prefix=captionname+NBSP, sep=SEPARATORS[separator],
+        numbersections=numbersections,
+        # Latex/pdf supports figure numbers by section natively.  For html,
+        # epub and docx, figure numbers by section must be hard-coded in
+        # as tags.
+        tag_secnos=numbersections and BACKENDS.get(family, Backend).tag_secnos,
+        # Section numbers are needed for numbering by section, and for
+        # epub links into chapter files
+        secnos=numbersections or epub,
+        secoffset=secoffset)
+
+
+# Backends -------------------------------------------------------------------
+
+def _raw(key, fmt, text):
+    """Returns a function that makes a new RawBlock (or RawInline, as given
+    by `key`) element with format `fmt` and text `text`."""
+    return lambda: {'t': key, 'c': [fmt, text]}
+
+def _figure_image(value):
+    """Returns the first Image in the Figure block with content `value`, or
+    None if there is none."""
+    for block in value[2][:1]:
+        if block['t'] in ['Plain', 'Para']:
+            for el in block['c']:
+                if el['t'] == 'Image':
+                    return el
+    return None
+
+def _figure_caption(value):
+    """Returns the caption inlines of the Figure block with content
+    `value`."""
+    blocks = value[1][1]
+    return blocks[0]['c'] if blocks and blocks[0]['t'] in ['Plain', 'Para'] \
+      else []
+
+def _set_caption(fig, value, caption):
+    """Sets the caption inlines of the figure `fig` with content `value`."""
+    if fig['key'] == 'Figure':
+        blocks = value[1][1]
+        if blocks and blocks[0]['t'] in ['Plain', 'Para']:
+            blocks[0]['c'] = caption
+        else:
+            blocks.insert(0, Plain(caption))
+    else:
+        value[0]['c'][1] = caption
+
+def _figure_block(fig, value):
+    """Returns the block for the figure `fig` with content `value`; i.e.,
+    a Figure (pandoc >= 3.0) or a Para."""
+    return {'t': 'Figure', 'c': value} if fig['key'] == 'Figure' \
+      else Para(value)
+
+class Backend(object):  # pylint: disable=useless-object-inheritance
+    """Renders figures for a family of output formats.
+
+    The caption and markup templates are built once per document from the
+    Config `config`.  They are functions that make new elements for each
+    figure, so that the elements may be edited in place.  This backend
+    hard-codes the caption name and number into captions and adds no
+    markup.  It is used for formats that have no backend of their own.
     """
 
-    # pylint: disable=global-statement
-    global cursec    # Current section being processed
-    global Ntargets  # Number of targets in current section (or document)
-    global has_unnumbered_figures  # Flags that unnumbered figures were found
+    # Flags that figure numbers by section must be hard-coded as tags
+    tag_secnos = False
+
+    def __init__(self, config):
+        """Builds the templates."""
+        self.config = config
+        prefix = config.caption_prefix
+        # Make the inlines that precede the number, and that separate the
+        # number and caption
+        self.caption_open = lambda: [{'t': 'Str', 'c': prefix}]
+        self.caption_close = lambda: [{'t': 'Space', 'c': []}]
+
+    def adjust_caption(self, fig, value):
+        """Adjusts the caption of the numbered figure `fig` with Para (or
+        Figure) content `value`."""
+        num, sep = fig['num'], self.config.sep
+        if isinstance(num, int):  # Numbered target
+            els = [Str('%d%s' % (num, sep))]
+        elif num.startswith('$') and num.endswith('$'):  # Math tag
+            math = num.replace(' ', r'\ ')[1:-1]
+            els = [Math({"t":"InlineMath", "c":[]}, math), Str(sep)]
+        else:  # Text tag
+            els = [Str(num+sep)]
+        _set_caption(fig, value, self.caption_open() + els + \
+                     self.caption_close() + list(fig['caption']))
+
+    def add_markup(self, fig, value):  # pylint: disable=unused-argument
+        """Returns the blocks that replace the figure `fig` with Para (or
+        Figure) content `value`, or None to leave the figure as it is."""
+        return None
+
+class LatexBackend(Backend):
+    """Renders figures for latex and beamer."""
+
+    def __init__(self, config):
+        """Builds the templates."""
+        super(LatexBackend, self).__init__(config)
+        self.no_prefix_open = \
+          _raw('RawBlock', 'tex', r'\begin{fignos:no-prefix-figure-caption}')
+        self.no_prefix_close = \
+          _raw('RawBlock', 'tex', r'\end{fignos:no-prefix-figure-caption}')
+        self.tagged_open = r'\begin{fignos:tagged-figure}[%s]'
+        self.tagged_close = \
+          _raw('RawBlock', 'tex', r'\end{fignos:tagged-figure}')
+
+    def adjust_caption(self, fig, value):
+        """Appends a \\label to the caption if the figure is referenceable.
+        Pandoc >= 1.17 installs the \\label itself."""
+        if not self.config.native_labels and not fig['is_unreferenceable']:
+            value[0]['c'][1] += \
+              [RawInline('tex', r'\protect\label{%s}'%fig['attrs'].id)]
 
-    # Initialize the return value
-    fig = {'is_unnumbered': False,
-           'is_unreferenceable': False,
-           'is_tagged': False}
+    def add_markup(self, fig, value):
+        """Encloses unnumbered and tagged figures in environments."""
+        if fig['is_unnumbered']:
+            # Use the no-prefix-figure-caption environment
+            return [self.no_prefix_open(), _figure_block(fig, value),
+                    self.no_prefix_close()]
+        if fig['is_tagged']:  # A figure cannot be tagged if unnumbered
+            # Use the tagged-figure environment
+            return [RawBlock('tex', self.tagged_open % str(fig['num'])),
+                    _figure_block(fig, value), self.tagged_close()]
+        return None
+
+class HtmlBackend(Backend):
+    """Renders figures for html and epub."""
+
+    tag_secnos = True
+
+    def __init__(self, config):
+        """Builds the templates."""
+        super(HtmlBackend, self).__init__(config)
+        prefix = config.caption_prefix
+        self.caption_open = \
+          lambda: [{'t': 'RawInline', 'c': ['html', r'<span>']},
+                   {'t': 'Str', 'c': prefix}]
+        self.caption_close = \
+          lambda: [{'t': 'RawInline', 'c': ['html', r'</span>']},
+                   {'t': 'Space', 'c': []}]
+        self.div_open = '<div id="%s" class="fignos">'
+        self.div_close = _raw('RawBlock', 'html', '</div>')
+
+    def add_markup(self, fig, value):
+        """Encloses the figure in a div that holds its id."""
+        if fig['is_unnumbered']:
+            return None
+        attrs = fig['attrs']
+        if LABEL_PATTERN.match(attrs.id):
+            ret = [RawBlock('html', self.div_open % attrs.id),
+                   _figure_block(fig, value), self.div_close()]
+            # Eliminate the id from the Image (or Figure)
+            attrs.id = ''
+            if fig['key'] == 'Figure':
+                value[0][0] = ''
+            else:
+                value[0]['c'][0] = attrs.list
+            return ret
+        return None
 
-    # Bail out if there are no attributes
-    if key == 'Para' and len(value[0]['c']) == 2:
-        has_unnumbered_figures = True
-        fig.update({'is_unnumbered': True, 'is_unreferenceable': True})
-        return fig
+class DocxBackend(Backend):
+    """Renders figures for docx."""
 
-    # Parse the figure
-    attrs = fig['attrs'] = \
-      PandocAttributes(value[0]['c'][0] if key == 'Para' else value[0],
-                       'pandoc')
-    fig['caption'] = value[0]['c'][1] if key == 'Para' else None
+    tag_secnos = True
 
-    # Bail out if the label does not conform to expectations
-    if not LABEL_PATTERN.match(attrs.id):
-        has_unnumbered_figures = True
-        fig.update({'is_unnumbered': True, 'is_unreferenceable': True})
-        return fig
+    def __init__(self, config):
+        """Builds the templates."""
+        super(DocxBackend, self).__init__(config)
+        # As per http://officeopenxml.com/WPhyperlink.php
+        self.bookmark_start = '<w:bookmarkStart w:id="0" w:name="%s"/>'
+        self.bookmark_end = \
+          _raw('RawBlock', 'openxml', '<w:bookmarkEnd w:id="0"/>')
 
-    # Identify unreferenceable figures
-    if attrs.id == 'fig:':
-        attrs.id += str(uuid.uuid4())
-        fig['is_unreferenceable'] = True
-
-    # Update the current section number
-    if attrs['secno'] != cursec:  # The section number changed
-        cursec = attrs['secno']   # Update the global section tracker
-        if numbersections:
-            Ntargets = 0          # Resets the global target counter
-
-    # Increment the targets counter
-    if 'tag' not in attrs:
-        Ntargets += 1
-
-    # Pandoc's --number-sections supports section numbering latex/pdf, html,
-    # epub, and docx
-    if numbersections:
-        # Latex/pdf supports equation numbers by section natively.  For the
-        # other formats we must hard-code in figure numbers by section as
-        # tags.
-        if fmt in ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3',
-                   'docx'] and \
-          'tag' not in attrs:
-            attrs['tag'] = str(cursec+secoffset) + '.' + str(Ntargets)
-
-    # Update the global targets tracker
-    fig['is_tagged'] = 'tag' in attrs
-    if fig['is_tagged']:  # ... then save the tag
-        # Remove any surrounding quotes
-        if attrs['tag'][0] == '"' and attrs['tag'][-1] == '"':
-            attrs['tag'] = attrs['tag'].strip('"')
-        elif attrs['tag'][0] == "'" and attrs['tag'][-1] == "'":
-            attrs['tag'] = attrs['tag'].strip("'")
-        targets[attrs.id] = pandocxnos.Target(attrs['tag'], cursec,
-                                              attrs.id in targets)
-    else:  # ... then save the figure number
-        targets[attrs.id] = pandocxnos.Target(Ntargets, cursec,
-                                              attrs.id in targets)
-
-    return fig
-
-def _adjust_caption(fmt, fig, value):
-    """Adjusts the caption."""
-    attrs, caption = fig['attrs'], fig['caption']
-    if fmt in ['latex', 'beamer']:  # Append a \label if this is referenceable
-        if version(PANDOCVERSION) < version('1.17') and \
-          not fig['is_unreferenceable']:
-            # pandoc >= 1.17 installs \label for us
-            value[0]['c'][1] += \
-              [RawInline('tex', r'\protect\label{%s}'%attrs.id)]
-    else:  # Hard-code in the caption name and number/tag
+    def add_markup(self, fig, value):
+        """Encloses the figure in a bookmark."""
         if fig['is_unnumbered']:
+            return None
+        return [RawBlock('openxml', self.bookmark_start % fig['attrs'].id),
+                _figure_block(fig, value), self.bookmark_end()]
+
+# The Backend classes for the output format families
+BACKENDS = {}
+
+def register_backend(family, backend, formats):
+    """Registers the Backend subclass `backend` for the output format
+    `family`, which is made up of the output `formats`."""
+    BACKENDS[family] = backend
+    for fmt in formats:
+        FAMILIES[fmt] = family
+
+register_backend('latex', LatexBackend, ['latex', 'beamer'])
+register_backend('html', HtmlBackend,
+                 ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3'])
+register_backend('docx', DocxBackend, ['docx'])
+
+
+# Actions --------------------------------------------------------------------
+
+# pylint: disable=too-many-arguments
+def first_pass_factory(process_figures, attach_attrs_image,
+                       detach_attrs_image, insert_secnos_img,
+                       delete_secnos_img, insert_secnos_div,
+                       delete_secnos_div):
+    """Returns first_pass(key, value, fmt, meta) action that combines the
+    given attribute and section number actions with the process_figures
+    action.  This allows the first pass to be done in a single walk.
+
+    Each of the combined actions acts only on a Header, a Para/Plain and
+    its immediate Image children, a Div, a Figure, or an Image.
+    Attributes are attached to the Images in a Para before the Para is
+    processed as a figure, and are detached from each Image when it is
+    reached afterwards.  Section numbers are tracked only once per Header.
+
+    The section number actions may be None if section numbers are not
+    needed.  The attribute actions are None for pandoc >= 3.0, whose
+    figures are Figure blocks with attributes of their own; the Figures
+    are processed directly and other Images are left alone.
+    """
+
+    secnos = insert_secnos_img is not None  # Flags section number tracking
+
+    def first_pass(key, value, fmt, meta):
+        """Processes the figures."""
+
+        if key == 'Header':  # Track the section number
+            if secnos:
+                insert_secnos_img(key, value, fmt, meta)
+
+        elif key == 'Figure':  # Section numbers are read by the action
+            return process_figures(key, value, fmt, meta)
+
+        elif key in ['Para', 'Plain'] and attach_attrs_image is not None:
+            attach_attrs_image(key, value, fmt, meta)
+            if key == 'Para' and len(value) == 1 and value[0]['t'] == 'Image':
+                if not secnos:
+                    return process_figures(key, value, fmt, meta)
+                image = value[0]
+                insert_secnos_img('Image', image['c'], fmt, meta)
+                ret = process_figures(key, value, fmt, meta)
+                delete_secnos_img('Image', image['c'], fmt, meta)
+                return ret
+
+        elif key == 'Div':
+            if not secnos:
+                return process_figures(key, value, fmt, meta)
+            insert_secnos_div(key, value, fmt, meta)
+            process_figures(key, value, fmt, meta)
+            delete_secnos_div(key, value, fmt, meta)
+
+        elif key == 'Image' and detach_attrs_image is not None:
+            detach_attrs_image(key, value, fmt, meta)
+
+        return None
+
+    return first_pass
+
+def second_pass_factory(process_refs, replace_refs):
+    """Returns second_pass(key, value, fmt, meta) action that repairs,
+    processes and replaces references in a single walk.
+
+    Each element is repaired and processed before it is replaced, and
+    before the walk reaches its contents.  Attributes for Spans must be
+    attached after the walk; use attach_attrs_factory(Span) as the post
+    action.
+    """
+
+    def second_pass(key, value, fmt, meta):
+        """Resolves the references."""
+        repair_refs(key, value, fmt, meta)
+        process_refs(key, value, fmt, meta)
+        return replace_refs(key, value, fmt, meta)
+
+    return second_pass
+
+def memoize_refs_factory(replace_refs, targets, rendered, count=None):
+    """Returns replace_refs(key, value, fmt, meta) action that renders each
+    form of reference once with the `replace_refs` action made by
+    replace_refs_factory(), and gives copies of the elements for later
+    references of the same form.
+
+    The renderings are held in the dict `rendered`, which should be kept
+    for one document.  They are keyed by the output format, the label, its
+    target in `targets` and the reference attributes (which hold the
+    modifier for clever and plural references).  A reference to a label
+    whose target changes, or that has no target yet, is thus rendered
+    again.  Bracketed references, which carry their own prefix and suffix,
+    and references to duplicate targets, which are warned about each
+    time, are rendered every time.  The renderings are stored marshalled
+    because loading them is the quickest way to make a copy.  Reuses and
+    renderings are counted with the Profile.count() method `count`, if
+    one is given.
+    """
+
+    def replace_refs_memoized(key, value, fmt, meta):
+        """Replaces references with format-specific content."""
+        if key != 'Cite' or len(value) != 3:
+            return replace_refs(key, value, fmt, meta)
+        text = value[-1]
+        if len(text) != 1 or text[0]['t'] != 'Str' or \
+          text[0]['c'].startswith('['):  # Possibly bracketed
+            return replace_refs(key, value, fmt, meta)
+        label = value[-2][0]['citationId']
+        target = targets.get(label)
+        if target is not None and target.has_duplicate:
+            return replace_refs(key, value, fmt, meta)
+        attrs = value[0]
+        memo = (fmt, label, target, attrs[0], tuple(attrs[1]),
+                tuple(tuple(kv) for kv in attrs[2]))
+        if memo in rendered:
+            if count:
+                count('reference_reuses')
+            return marshal.loads(rendered[memo])
+        ret = replace_refs(key, value, fmt, meta)
+        rendered[memo] = marshal.dumps(ret)
+        if count:
+            count('reference_renderings')
+        return ret
+
+    return replace_refs_memoized
+
+
+# Planning -------------------------------------------------------------------
+
+def plan_passes(text):
+    """Scans the document json `text` (or bytes) and returns a dict that
+    flags which passes are needed to filter it.  The text is not decoded;
+    element types and labels are searched for as substrings.  This errs on
+    the side of doing a pass.
+
+    The returned dict has the following fields:
+
+      first_pass - flags that there may be figures to process
+      second_pass - flags that there may be references to process
+      meta - flags that there may be fignos/xnos metadata to process
+      passthrough - flags that the document can be written as is
+    """
+    def found(s):
+        """Returns True if `s` is in the text (or bytes)."""
+        return (s.encode('utf-8') if isinstance(text, bytes) else s) in text
+    has_labels = found('fig:')
+    plan = {'first_pass': has_labels or found('"Image"'),
+            'second_pass': (has_labels and found('"Cite"')) or \
+                           found('"Span"') or \
+                           (found('"Link"') and found('@')),
+            'meta': found('fignos-') or found('xnos-')}
+    plan['passthrough'] = not (plan['first_pass'] or plan['second_pass'] or
+                               plan['meta'])
+    return plan
+
+# The start of document json, and the ends of the dict (pandoc >= 1.18) and
+# list forms, for check_document()
+_DOCUMENT_START = re.compile(r'\s*(?:(\{)|\[\s*\{\s*"unMeta"\s*:)')
+_DICT_END = re.compile(r'[\]}]\s*\}\s*$')
+_LIST_END = re.compile(r'\]\s*\]\s*$')
+
+def check_document(text):
+    """Raises a ValueError if the json `text` (or bytes) does not look like
+    a pandoc document, so that input that is malformed or truncated is not
+    passed through.  The text is not decoded; only its start and end, and
+    the keys of the dict form, are checked."""
+    head, tail = text[:64], text[-64:]
+    if isinstance(text, bytes):
+        head, tail = head.decode('latin-1'), tail.decode('latin-1')
+    match = _DOCUMENT_START.match(head)
+    if match and match.group(1):  # pandoc >= 1.18
+        keys = [b'"meta"', b'"blocks"'] if isinstance(text, bytes) else \
+          ['"meta"', '"blocks"']
+        if _DICT_END.search(tail) and all(key in text for key in keys):
             return
-        sep = {'none':'', 'colon':':', 'period':'.', 'space':' ',
-               'quad':u'\u2000', 'newline':'\n'}[separator]
+    elif match and _LIST_END.search(tail):
+        return
+    raise ValueError('Not a pandoc json document.')
+
+def report_plan(plan, secnos):
+    """Writes the pass plan to stderr."""
+    if plan['passthrough']:
+        msg = 'pandoc-fignos: Nothing to do; passing the document through.\n'
+    else:
+        msg = 'pandoc-fignos: Passes: first %s, second %s; ' \
+              'section numbers %s.\n' % \
+              ('on' if plan['first_pass'] else 'off',
+               'on' if plan['second_pass'] else 'off',
+               'on' if secnos else 'off')
+    STDERR.write(msg)
+    STDERR.flush()
 
-        num = targets[attrs.id].num
-        if isinstance(num, int):  # Numbered target
-            if fmt in ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3']:
-                value[0]['c'][1] = [RawInline('html', r'<span>'),
-                                    Str(captionname+NBSP),
-                                    Str('%d%s' % (num, sep)),
-                                    RawInline('html', r'</span>')]
-            else:
-                value[0]['c'][1] = [Str(captionname+NBSP),
-                                    Str('%d%s' % (num, sep))]
-        else:  # Tagged target
-            if num.startswith('$') and num.endswith('$'):  # Math
-                math = num.replace(' ', r'\ ')[1:-1]
-                els = [Math({"t":"InlineMath", "c":[]}, math), Str(sep)]
-            else:  # Text
-                els = [Str(num+sep)]
-            if fmt in ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3']:
-                value[0]['c'][1] = \
-                  [RawInline('html', r'<span>'), Str(captionname+NBSP)] + \
-                  els + [RawInline('html', r'</span>')]
-            else:
-                value[0]['c'][1] = [Str(captionname+NBSP)] + els
-        value[0]['c'][1] += [Space()] + list(caption)
 
-def _add_markup(fmt, fig, value):
-    """Adds markup to the output."""
+# Codecs ---------------------------------------------------------------------
 
-    # pylint: disable=global-statement
-    global has_tagged_figures  # Flags a tagged figure was found
+class JSONCodec(object):  # pylint: disable=useless-object-inheritance
+    """Decodes and encodes documents with the json module.
 
-    if fig['is_unnumbered']:
-        if fmt in ['latex', 'beamer']:
-            # Use the no-prefix-figure-caption environment
-            return [RawBlock('tex', r'\begin{fignos:no-prefix-figure-caption}'),
-                    Para(value),
-                    RawBlock('tex', r'\end{fignos:no-prefix-figure-caption}')]
-        return None  # Nothing to do
+    Documents are encoded as compact utf-8 json, which is what the faster
+    codecs write, so that the output is the same whichever codec is used.
+    (Floats that need exponents, which are outside of the range of pandoc's
+    column widths, are the exception.  Under Python 2, non-ascii characters
+    are escaped if the document mixes strs and unicode.)
+    """
 
-    attrs = fig['attrs']
-    ret = None
+    name = 'json'
+
+    @staticmethod
+    def loads(data):
+        """Decodes the json bytes (or text) `data`."""
+        if isinstance(data, bytes) and bytes is not str:
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(doc):
+        """Encodes `doc` as json bytes."""
+        try:
+            return json.dumps(doc, separators=(',', ':'),
+                              ensure_ascii=False).encode('utf-8')
+        except UnicodeEncodeError:  # Unpaired surrogates must be escaped
+            return json.dumps(doc, separators=(',', ':')).encode('utf-8')
+        except UnicodeDecodeError:  # Python 2 strs mixed with unicode
+            return json.dumps(doc, separators=(',', ':'))
+
+class OrjsonCodec(JSONCodec):
+    """Decodes and encodes documents with orjson.  Documents that orjson
+    does not accept (e.g., with unpaired surrogates or very large
+    integers) are left to the json module."""
+
+    name = 'orjson'
+
+    def __init__(self):
+        """Imports orjson.  Raises ImportError if it is not installed."""
+        import orjson  # pylint: disable=import-error
+        self.orjson = orjson
+
+    def loads(self, data):
+        """Decodes the json bytes (or text) `data`."""
+        try:
+            return self.orjson.loads(data)
+        except ValueError:
+            return JSONCodec.loads(data)
+
+    def dumps(self, doc):
+        """Encodes `doc` as json bytes."""
+        try:
+            return self.orjson.dumps(doc)
+        except TypeError:
+            return JSONCodec.dumps(doc)
+
+# The codecs in order of preference
+CODECS = [OrjsonCodec, JSONCodec]
+
+def get_codec(name=None):
+    """Returns the codec called `name`, or the first codec in CODECS that
+    is installed.  The name may also be set with the FIGNOS_CODEC
+    environment variable."""
+    name = name or os.environ.get('FIGNOS_CODEC')
+    for codec in CODECS:
+        if name in (None, codec.name):
+            try:
+                return codec()
+            except ImportError:
+                if name:
+                    raise
+    raise ValueError('Unknown codec: %s' % name)
+
+def write_json(stdout, data):
+    """Writes the json bytes (or text) `data` to `stdout`.  Bytes are
+    written to the underlying binary buffer of a text stream, if it has
+    one."""
+    if not isinstance(data, bytes):
+        stdout.write(data)
+    elif hasattr(stdout, 'buffer'):
+        stdout.flush()
+        stdout.buffer.write(data)
+    elif isinstance(stdout, io.TextIOBase):
+        stdout.write(data.decode('utf-8'))
+    else:  # A binary stream, or a Python 2 file
+        stdout.write(data)
+
+def save_json(path, data, indent=None):
+    """Saves `data` as json to the file at `path`.  The file is written
+    under a temporary name and then renamed, so that readers never see a
+    partly written file."""
+    text = json.dumps(data, indent=indent)
+    if isinstance(text, bytes):  # Python 2
+        text = text.decode('utf-8')
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    with io.open(tmppath, 'w', encoding='utf-8') as f:
+        f.write(text + u'\n')
+    getattr(os, 'replace', os.rename)(tmppath, path)
+
+
+# Profiling ------------------------------------------------------------------
+
+class Profile(object):  # pylint: disable=useless-object-inheritance
+    """Records the time taken by each stage of the filter, and counts the
+    nodes visited by the passes, the figures processed and the references
+    replaced."""
+
+    def __init__(self, hot=False):
+        """Initializes the profile.  The hot functions are found with
+        cProfile if `hot` is True."""
+        self.start = time.time()
+        self.times = {}   # Times for the stages (s)
+        self.counts = {}  # Counts of things done
+        self.profiler = None
+        if hot:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the stage `name` over a with statement."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.time() - start
+
+    def count(self, name, n=1):
+        """Adds `n` to the count `name`."""
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def counter(self, name, action, changes=False):
+        """Returns `action` wrapped so that its calls are counted as `name`.
+        Only calls that change an element are counted if `changes` is
+        True."""
+        def counted(key, value, fmt, meta):
+            """Counts the action."""
+            ret = action(key, value, fmt, meta)
+            if not changes or ret is not None:
+                self.counts[name] = self.counts.get(name, 0) + 1
+            return ret
+        return counted
+
+    def report(self, **info):
+        """Returns the report as a dict that includes the fields in
+        `info`."""
+        report = dict(info)
+        report.update({'filter': 'pandoc-fignos', 'version': __version__,
+                       'total': time.time() - self.start,
+                       'stages': self.times, 'counts': self.counts})
+        if self.profiler:  # Add the functions with the largest own times
+            import pstats
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler).stats
+            report['hot_functions'] = [
+                {'function': '%s:%d(%s)' % key, 'calls': value[1],
+                 'tottime': value[2], 'cumtime': value[3]}
+                for key, value in sorted(stats.items(),
+                                         key=lambda item: -item[1][2])[:20]]
+        return report
+
+    def write(self, dest, **info):
+        """Writes the json report to the file `dest`, or to stderr if
+        `dest` is '-'."""
+        report = self.report(**info)
+        if dest == '-':
+            STDERR.write(json.dumps(report, indent=2) + '\n')
+            STDERR.flush()
+        else:
+            save_json(dest, report, indent=2)
+
+
+# Streaming ------------------------------------------------------------------
+
+# Matches json whitespace
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class JSONReader(object):  # pylint: disable=useless-object-inheritance
+    """Reads json values one at a time from a text stream.  Only the text
+    needed for the current value is held in memory."""
+
+    def __init__(self, stream, chunksize=1<<16):
+        """Initializes the reader for the text `stream`."""
+        self.stream = stream
+        self.chunksize = chunksize
+        self.buf = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Reads more text into the buffer.  The amount read grows with the
+        value being decoded.  Returns False at the end of the stream."""
+        chunk = self.stream.read(max(self.chunksize, len(self.buf)-self.pos))
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or '' at the
+        end of the stream."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, c):
+        """Consumes the character `c`, which must come next."""
+        if self.peek() != c:
+            raise ValueError('Expected %r at position %d.' % (c, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Decodes and returns the next value."""
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:  # The value may be incomplete
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may be incomplete
+            if end == len(self.buf) and not isinstance(val, (dict, list)) \
+              and self._fill():
+                continue
+            self.pos = end
+            return val
+
+    def items(self):
+        """Generates the items of the array that comes next."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def read(self):
+        """Returns the rest of the stream."""
+        text = self.buf[self.pos:] + self.stream.read()
+        self.buf, self.pos = '', 0
+        return text
+
+
+
+# Cache ----------------------------------------------------------------------
+
+# Changes whenever the cached output would change for the same input
+CACHE_FORMAT = 4
+
+# The default cache size limit (bytes)
+CACHE_SIZE = 256 << 20
+
+@contextlib.contextmanager
+def _capture_messages():
+    """Captures the messages written to stderr by the filter and by
+    pandocxnos over a with statement.  Yields the buffer."""
+    global STDERR  # pylint: disable=global-statement
+    stderr = STDERR
+    if sys.version_info > (3,):
+        buf = io.StringIO()
+    else:  # Messages are native strs, which io.StringIO() doesn't accept
+        import StringIO  # pylint: disable=import-error
+        buf = StringIO.StringIO()
+    STDERR = pandocxnos.core.STDERR = buf
+    try:
+        yield STDERR
+    finally:
+        STDERR = pandocxnos.core.STDERR = stderr
+
+class BlockCache(object):  # pylint: disable=useless-object-inheritance
+    """An on-disk cache of filtered blocks.
+
+    Entries are json files named by the hash of their key and are stored
+    under `path`.  The least recently used entries are evicted once the
+    total size is above `maxsize` bytes.  The hits and misses for each pass
+    are counted in `stats`.
+    """
 
-    if fmt in ['latex', 'beamer']:
-        if fig['is_tagged']:  # A figure cannot be tagged if it is unnumbered
-            # Use the tagged-figure environment
-            has_tagged_figures = True
-            ret = [RawBlock('tex', r'\begin{fignos:tagged-figure}[%s]' % \
-                            str(targets[attrs.id].num)),
-                   Para(value),
-                   RawBlock('tex', r'\end{fignos:tagged-figure}')]
-    elif fmt in ('html', 'html4', 'html5', 'epub', 'epub2', 'epub3'):
-        if LABEL_PATTERN.match(attrs.id):
-            pre = RawBlock('html', '<div id="%s" class="fignos">'%attrs.id)
-            post = RawBlock('html', '</div>')
-            ret = [pre, Para(value), post]
-            # Eliminate the id from the Image
-            attrs.id = ''
-            value[0]['c'][0] = attrs.list
-    elif fmt == 'docx':
-        # As per http://officeopenxml.com/WPhyperlink.php
-        bookmarkstart = \
-          RawBlock('openxml',
-                   '<w:bookmarkStart w:id="0" w:name="%s"/>'
-                   %attrs.id)
-        bookmarkend = \
-          RawBlock('openxml', '<w:bookmarkEnd w:id="0"/>')
-        ret = [bookmarkstart, Para(value), bookmarkend]
-    return ret
-
-def process_figures(key, value, fmt, meta):  # pylint: disable=unused-argument
-    """Processes the figures."""
-
-    # Process figures wrapped in Para elements
-    if key == 'Para' and len(value) == 1 and \
-      value[0]['t'] == 'Image' and value[0]['c'][-1][1].startswith('fig:'):
-
-        # Process the figure and add markup
-        fig = _process_figure(key, value, fmt)
-        if 'attrs' in fig:
-            _adjust_caption(fmt, fig, value)
-        return _add_markup(fmt, fig, value)
-
-    if key == 'Div' and LABEL_PATTERN.match(value[0][0]):
-        fig = _process_figure(key, value, fmt)
+    def __init__(self, path, maxsize=CACHE_SIZE):
+        """Initializes the cache in the directory `path`."""
+        self.path = path
+        self.maxsize = maxsize
+        self.stats = {}
+        self.stored = False  # Flags that entries were added
+
+    @staticmethod
+    def key(*parts):
+        """Returns the key for the json-serializable `parts`."""
+        import hashlib
+        return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        """Returns the path for the entry `key`."""
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def count(self, name):
+        """Adds one to the statistic `name`."""
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+    def get(self, key):
+        """Returns the entry for `key`, or None if there is none.  The
+        entry is marked as recently used."""
+        path = self._entry_path(key)
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        """Stores the `entry` for `key`."""
+        path = self._entry_path(key)
+        dirname = os.path.dirname(path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            save_json(path, entry)
+        except (IOError, OSError):  # Another process may be using the cache
+            if not os.path.isdir(dirname):
+                raise
+        self.stored = True
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is no
+        larger than its size limit."""
+        if not self.stored:
+            return
+        entries = []
+        size = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:  # Removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                size += st.st_size
+        for _, nbytes, path in sorted(entries):
+            if size <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= nbytes
+            self.count('evictions')
+
+    def report(self):
+        """Reports the statistics to stderr."""
+        stats = ', '.join('%d %s' % (self.stats[name], name.replace('_', ' '))
+                          for name in sorted(self.stats))
+        STDERR.write('\npandoc-fignos: Cache: %s.\n' % (stats or 'unused'))
+        STDERR.flush()
+
+
+# Target index ---------------------------------------------------------------
+
+class TargetIndex(object):  # pylint: disable=useless-object-inheritance
+    """The figure targets of the chapters of a book, for filtering the
+    chapters separately.
+
+    The index is filled by FignosFilter.collect() and is saved as a json
+    file.  It holds the numbering state at the start of each chapter, and
+    the number, section number and chapter of each target.  `chapter` is
+    the name of the chapter being filtered, if it is known; the
+    fignos-chapter meta variable takes precedence.
+    """
 
-    return None
+    def __init__(self, path=None, chapter=None, data=None):
+        """Loads the index from the file at `path`, or from the dict `data`
+        given by data(), if one is given."""
+        self.chapter = chapter
+        self.chapters = []  # [name, start state] pairs in book order
+        self.targets = {}   # Maps labels to [num, secno, chapter name]
+        if path is not None:
+            with io.open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        if data is not None:
+            self.chapters = data['chapters']
+            self.targets = data['targets']
+
+    def add_chapter(self, name, start, targets):
+        """Adds the chapter `name` with the numbering state `start` and the
+        [label, num, secno] `targets`."""
+        self.chapters.append([name, start])
+        for label, num, secno in targets:
+            self.targets[label] = [num, secno, name]
+
+    def start(self, name):
+        """Returns the numbering state at the start of the chapter `name`,
+        or None if there is no such chapter."""
+        for chapter, start in self.chapters:
+            if chapter == name:
+                return start
+        return None
+
+    def data(self):
+        """Returns the index as a json-serializable dict."""
+        return {'chapters': self.chapters, 'targets': self.targets}
+
+    def save(self, path):
+        """Saves the index to the file at `path`."""
+        save_json(path, self.data())
+
+def chapter_name(path):
+    """Returns the chapter name for the json file at the relative `path`;
+    i.e., the path without its extension."""
+    return os.path.splitext(path)[0]
+
+
+# Manifest -------------------------------------------------------------------
+
+class Manifest(object):  # pylint: disable=useless-object-inheritance
+    """The figures of a document and the references to them, for build
+    tools.
+
+    Each figure is recorded with its label, number (or tag), section
+    number, image path and caption text.  Unnumbered figures have no label
+    or number.  Each reference is recorded with the label it points at
+    and the number of its target (None if there is no target), in
+    document order.
+    """
+
+    # The fields of the csv file
+    FIELDS = ['kind', 'label', 'number', 'section', 'image', 'caption']
+
+    def __init__(self, data=None):
+        """Initializes the manifest, from the dict `data` given by data()
+        if there is one."""
+        self.figures = data['figures'] if data else []
+        self.references = data['references'] if data else []
+
+    def clear(self):
+        """Removes all of the figures and references."""
+        del self.figures[:]
+        del self.references[:]
+
+    # pylint: disable=too-many-arguments
+    def add_figure(self, label, number, section, image, caption):
+        """Adds a figure."""
+        self.figures.append({'label': label, 'number': number,
+                             'section': section, 'image': image,
+                             'caption': caption})
+
+    def add_references(self, labels, targets):
+        """Adds references to the `labels`, whose targets are looked up in
+        the dict `targets`."""
+        for label in labels:
+            target = targets.get(label)
+            self.references.append({'label': label,
+                                    'number': target.num if target else None})
+
+    def data(self):
+        """Returns the manifest as a json-serializable dict."""
+        return {'figures': self.figures, 'references': self.references}
+
+    def save(self, path):
+        """Saves the manifest to the file at `path`.  A csv file is written
+        if the path ends with '.csv', and a json file otherwise."""
+        if path.lower().endswith('.csv'):
+            import csv
+            rows = [dict(figure, kind='figure') for figure in self.figures] + \
+              [dict(ref, kind='reference') for ref in self.references]
+            if sys.version_info < (3,):  # The csv module writes strs
+                rows = [dict((key, value.encode('utf-8')
+                              if isinstance(value, type(u'')) else value)
+                             for key, value in row.items()) for row in rows]
+            if sys.version_info > (3,):
+                f = io.open(path, 'w', encoding='utf-8', newline='')
+            else:
+                f = open(path, 'wb')
+            with f:
+                writer = csv.DictWriter(f, self.FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            save_json(path, self.data(), indent=2)
+
+
+# Patches --------------------------------------------------------------------
+
+def top_level(doc):
+    """Returns the paths (as tuples) and values of the meta dict and the
+    block list of the document AST `doc`."""
+    if isinstance(doc, dict):  # pandoc >= 1.18
+        return ('meta',), doc['meta'], ('blocks',), doc['blocks']
+    return (0, 'unMeta'), doc[0]['unMeta'], (1,), doc[1]
+
+def _key(x):
+    """Returns bytes that are equal for equal element trees `x` (with their
+    dict keys in the same order).  Marshal version 2 does not share
+    repeated objects, and so depends only on the values."""
+    return marshal.dumps(x, 2)
+
+def snapshot(doc):
+    """Returns a snapshot of the document AST `doc` before it is filtered,
+    for make_patch().  The snapshot holds the top-level blocks and a
+    marshalled copy of each, and a copy of the metadata."""
+    _, meta, _, blocks = top_level(doc)
+    return {'meta': marshal.loads(_key(meta)), 'blocks': list(blocks),
+            'keys': [_key(block) for block in blocks]}
+
+def _pointer(path):
+    """Returns the json pointer (RFC 6901) for the tuple `path`."""
+    return ''.join('/' + str(part).replace('~', '~0').replace('/', '~1')
+                   for part in path)
+
+def _patch_blocks(patch, path, n, keys, new):
+    """Appends to `patch` the operations that change the blocks with the
+    `keys` into the blocks `new`, at index `n` of the block list at `path`.
+    Returns the index that follows the new blocks."""
+    import difflib
+    matcher = difflib.SequenceMatcher(None, keys, [_key(block) for block
+                                                   in new], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            n += j2 - j1
+            continue
+        for j in range(j1, j2):
+            patch.append({'op': 'replace' if i1 + j - j1 < i2 else 'add',
+                          'path': _pointer(path+(n,)), 'value': new[j]})
+            n += 1
+        for _ in range(i2 - i1 - (j2 - j1)):
+            patch.append({'op': 'remove', 'path': _pointer(path+(n,))})
+    return n
+
+def make_patch(snap, doc):
+    """Returns a json patch (RFC 6902) that changes the document AST from
+    the snapshot `snap` (see snapshot()) into `doc`.  The patch is a list
+    of operations that add, replace and remove whole meta entries and
+    top-level blocks.
+
+    The blocks that are still in `doc` are matched with the snapshot by
+    identity, and are replaced only if they were changed in place.  The
+    blocks inserted between them (e.g., figure markup, or blocks filtered
+    in other processes) are matched with the blocks that were removed by
+    their contents.
+    """
+    metapath, meta, blockspath, blocks = top_level(doc)
+    meta0, keys = snap['meta'], snap['keys']
+    patch = []
+
+    # Meta entries
+    for key in meta0:
+        if key not in meta:
+            patch.append({'op': 'remove', 'path': _pointer(metapath+(key,))})
+        elif meta[key] != meta0[key]:
+            patch.append({'op': 'replace', 'path': _pointer(metapath+(key,)),
+                          'value': meta[key]})
+    for key in meta:
+        if key not in meta0:
+            patch.append({'op': 'add', 'path': _pointer(metapath+(key,)),
+                          'value': meta[key]})
+
+    # Blocks.  Each kept block closes a run of blocks that were removed and
+    # blocks that were inserted.
+    index = dict((id(block), i) for i, block in enumerate(snap['blocks']))
+    start = 0  # The first snapshot block not yet accounted for
+    n = 0      # The index in the patched block list
+    inserted = []
+    for block in blocks + [None]:
+        i = len(keys) if block is None else index.get(id(block))
+        if i is None or i < start:  # Inserted by the filter
+            inserted.append(block)
+            continue
+        n = _patch_blocks(patch, blockspath, n, keys[start:i], inserted)
+        inserted = []
+        if block is None:
+            break
+        if _key(block) != keys[i]:  # Changed in place
+            patch.append({'op': 'replace', 'path': _pointer(blockspath+(n,)),
+                          'value': block})
+        start = i + 1
+        n += 1
+
+    return patch
+
+def apply_patch(doc, patch):
+    """Applies the json `patch` (RFC 6902) to the document AST `doc` in
+    place and returns it.  Only the add, remove and replace operations,
+    which make_patch() uses, are supported; others raise a ValueError."""
+    for op in patch:
+        parts = [part.replace('~1', '/').replace('~0', '~')
+                 for part in op['path'].split('/')[1:]]
+        parent = doc
+        for part in parts[:-1]:
+            parent = parent[int(part) if isinstance(parent, list) else part]
+        key = parts[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == '-' else int(key)
+        if op['op'] == 'add':
+            if isinstance(parent, list):
+                parent.insert(key, op['value'])
+            else:
+                parent[key] = op['value']
+        elif op['op'] == 'replace':
+            if isinstance(parent, dict) and key not in parent:
+                raise KeyError(op['path'])
+            parent[key] = op['value']
+        elif op['op'] == 'remove':
+            del parent[key]
+        else:
+            raise ValueError('Unsupported patch operation: %s' % op['op'])
+    return doc
+
+
+# Parallel -------------------------------------------------------------------
+
+def split_sections(blocks, n):
+    """Splits the list `blocks` into about `n` chunks of similar size.
+    Chunks start at the Headers of the top level in the document (level 1,
+    where sections are numbered), where possible.  Returns the (start, end)
+    indices of the chunks; there is always at least one."""
+    size = max(len(blocks) // n, 1)
+    levels = [block['c'][0] for block in blocks if block['t'] == 'Header']
+    top = min(levels) if levels else None
+    chunks = []
+    start = 0
+    for i, block in enumerate(blocks):
+        if i - start >= size and block['t'] == 'Header' and \
+          block['c'][0] == top:
+            chunks.append((start, i))
+            start = i
+    chunks.append((start, len(blocks)))
+    return chunks
+
+def _filter_chunk(task):
+    """Filters a chunk of the sections of a document, for
+    FignosFilter.filter() in parallel mode.  This is done in a worker
+    process.  Returns a dict with the filtered blocks, the pandocxnos
+    state and the messages.
+
+    The `task` dict gives the output format, pandoc version, metadata and
+    plan, the numbering state at the start of the chunk, the targets of
+    the whole document (as [label, num, secno, has_duplicate] lists), the
+    blocks, and flags that the work be counted and that the labels of the
+    references be returned.
+    """
+    # pylint: disable=protected-access
+    fignos = FignosFilter(profile=Profile() if task['counting'] else None)
+    fmt, meta, blocks = task['fmt'], task['meta'], task['blocks']
+    with _XNOS_LOCK:
+        with _capture_messages():  # These were reported by the parent
+            fignos.init(task['pandocversion'], {})
+            fignos.process(meta)
+            links = not fignos.configure(fmt).api
+        with _capture_messages() as buf:
+            fignos._set_state(task['state'])
+            if task['plan']['first_pass']:
+                apply_first_pass(index_document(blocks, links)['figures'],
+                                 fignos.make_first_pass(), fmt, meta)
+            fignos.targets = dict((target[0],
+                                   pandocxnos.Target(*target[1:]))
+                                  for target in task['targets'])
+            labels = []
+            second_pass, attach_attrs_span = fignos.make_second_pass(
+                labels if task['manifest'] else None)
+            if task['plan']['second_pass']:
+                for _, el in index_document(blocks, links)['refs']:
+                    walk([el], second_pass, fmt, meta,
+                         post=attach_attrs_span)
+        return {'blocks': blocks,
+                'cleveref': bool(pandocxnos.core._cleveref_flag),
+                'badrefs': [[label, '\n%s: Bad reference: @%s.\n' % \
+                             (pandocxnos.core._FILTERNAME, label)]
+                            for label in pandocxnos.core.badlabels],
+                'flags': [fignos.has_unnumbered_figures,
+                          fignos.has_tagged_figures],
+                'messages': buf.getvalue(),
+                'counts': fignos.profile.counts, 'labels': labels}
 
 
 # TeX blocks -----------------------------------------------------------------
@@ -383,214 +1544,1141 @@ SECOFFSET_TEX = r"""
 """
 
 
-# Main program ---------------------------------------------------------------
+# Filter ---------------------------------------------------------------------
 
-# pylint: disable=too-many-branches,too-many-statements
-def process(meta):
-    """Saves metadata fields in global variables and returns a few
-    computed fields."""
-
-    # pylint: disable=global-statement
-    global captionname     # The caption name
-    global separator       # The caption separator
-    global cleveref        # Flags that clever references should be used
-    global capitalise      # Flags that plusname should be capitalised
-    global plusname        # Sets names for mid-sentence references
-    global starname        # Sets names for references at sentence start
-    global numbersections  # Flags that sections should be numbered by section
-    global secoffset       # Section number offset
-    global warninglevel    # 0 - no warnings; 1 - some; 2 - all
-    global captionname_changed  # Flags the caption name changed
-    global separator_changed    # Flags the caption separator changed
-    global plusname_changed     # Flags that the plus name changed
-    global starname_changed     # Flags that the star name changed
-
-    # Read in the metadata fields and do some checking
-
-    for name in ['fignos-warning-level', 'xnos-warning-level']:
-        if name in meta:
-            warninglevel = int(get_meta(meta, name))
-            pandocxnos.set_warning_level(warninglevel)
-            break
+# Guards the module-level state in pandocxnos, which all filters share
+_XNOS_LOCK = threading.RLock()
 
-    metanames = ['fignos-warning-level', 'xnos-warning-level',
-                 'fignos-caption-name',
-                 'fignos-caption-separator', 'xnos-caption-separator',
-                 'fignos-cleveref', 'xnos-cleveref',
-                 'xnos-capitalise', 'xnos-capitalize',
-                 'fignos-plus-name', 'fignos-star-name',
-                 'fignos-number-by-section', 'xnos-number-by-section',
-                 'xnos-number-offset']
-
-    if warninglevel:
-        for name in meta:
-            if (name.startswith('fignos') or name.startswith('xnos')) and \
-              name not in metanames:
-                msg = textwrap.dedent("""
-                          pandoc-fignos: unknown meta variable "%s"
-                      """ % name)
-                STDERR.write(msg)
-
-    if 'fignos-caption-name' in meta:
-        old_captionname = captionname
-        captionname = get_meta(meta, 'fignos-caption-name')
-        captionname_changed = captionname != old_captionname
-        assert isinstance(captionname, STRTYPES)
-
-    for name in ['fignos-caption-separator', 'xnos-caption-separator']:
-        if name in meta:
-            old_separator = separator
-            separator = get_meta(meta, name)
-            if separator not in \
-              ['none', 'colon', 'period', 'space', 'quad', 'newline']:
-                msg = textwrap.dedent("""
-                          pandoc-fignos: caption separator must be one of
-                          none, colon, period, space, quad, or newline.
-                      """ % name)
-                STDERR.write(msg)
-                continue
-            separator_changed = separator != old_separator
-            break
+class FignosFilter(object):  # pylint: disable=useless-object-inheritance
+    """Numbers the figures and resolves the figure references in documents.
 
-    for name in ['fignos-cleveref', 'xnos-cleveref']:
-        # 'xnos-cleveref' enables cleveref in all 3 of fignos/eqnos/tablenos
-        if name in meta:
-            cleveref = check_bool(get_meta(meta, name))
-            break
+    The meta variables and processing state are held by the instance, so
+    that documents can be filtered back to back, or concurrently from
+    several threads using one filter per thread.  The passes themselves
+    are serialized because pandocxnos keeps its state in module variables.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, verbose=False, profile=None, index=None,
+                 manifest=None):
+        """Initializes the filter.  Processing details are reported to
+        stderr if `verbose` is True.  The stages are timed and counted in
+        the Profile `profile`, if one is given.  Targets in other chapters
+        are resolved using the TargetIndex `index`, if one is given.  The
+        figures and references of each document are recorded in the
+        Manifest `manifest`, if one is given."""
+        self.verbose = verbose  # Flags that processing details be reported
+        self.counting = profile is not None  # Flags that things be counted
+        self.profile = profile if self.counting else Profile()
+        self.index = index
+        self.manifest = manifest
+        self.reset()
+
+    def reset(self):
+        """Resets the meta variables and processing state."""
+
+        # Meta variables
+        self.captionname = 'Figure'  # The caption name
+        self.separator = 'colon'     # The caption separator
+        self.cleveref = False    # Flags that clever references should be used
+        self.capitalise = False  # Flags that plusname should be capitalised
+        self.plusname = ['fig.', 'figs.']  # Names for mid-sentence references
+        self.starname = ['Figure', 'Figures']  # Names at sentence start
+        self.numbersections = False  # Flags figures be numbered by section
+        self.secoffset = 0           # Section number offset
+        self.warninglevel = 2  # 0 - no warnings; 1 - some; 2 - all warnings
+        self.chapter = None    # The chapter name in the target index
+
+        # Processing state variables
+        self.cursec = None  # Current section
+        self.Ntargets = 0   # Number of targets in current section (or doc)
+        self.Nfigures = 0   # Number of labelled figures in the doc
+        self.targets = {}   # Targets tracker
+        self.rendered = {}  # Rendered references; see memoize_refs_factory()
+
+        # Processing flags
+        self.captionname_changed = False  # Flags the caption name changed
+        self.separator_changed = False    # Flags the caption separator changed
+        self.plusname_changed = False     # Flags that the plus name changed
+        self.starname_changed = False     # Flags that the star name changed
+        self.has_unnumbered_figures = False  # Flags unnumbered figures found
+        self.has_tagged_figures = False      # Flags a tagged figure was found
+
+        # Targets added by the first pass are logged here if it is a list
+        self.target_log = None
+        if self.manifest is not None:
+            self.manifest.clear()
+
+        # The pandoc version, element primitives and configuration
+        self.pandocversion = None
+        self.Image = Image
+        self.config = None   # Set by configure()
+        self.backend = None  # Set by configure()
+
+    def _extract_attrs(self, x, n):
+        """Extracts attributes for an image in the element list `x`.  The
+        attributes begin at index `n`.  Extracted elements are deleted
+        from the list.
+        """
+        try:  #  Try the standard call from pandocxnos first
+            return extract_attrs(x, n)
+
+        except (ValueError, IndexError):
+
+            if not self.config.image_attrs:
+                # Look for attributes attached to the image path, as occurs
+                # with image references for pandoc < 1.16 (pandoc-fignos
+                # Issue #14).  See http://pandoc.org/MANUAL.html#images for
+                # the syntax.  Note: This code does not handle the "optional
+                # title" for image references (search for link_attributes in
+                # pandoc's docs).
+                assert x[n-1]['t'] == 'Image'
+                image = x[n-1]
+                s = image['c'][-1][0]
+                if '%20%7B' in s:
+                    path = s[:s.index('%20%7B')]
+                    if sys.version_info > (3,):
+                        from urllib.parse import unquote
+                    else:
+                        # pylint: disable=no-name-in-module
+                        from urllib import unquote
+                    attrstr = unquote(s[s.index('%7B'):])
+                    image['c'][-1][0] = path  # Remove attr string from path
+                    return PandocAttributes(attrstr.strip(), 'markdown')
+            raise
+
+
+    def _process_figure(self, key, value, fmt):
+        """Processes a figure.  Returns a dict containing figure properties.
+
+        Parameters:
+
+          key - 'Para' (for a normal figure), 'Figure' (for a pandoc >= 3.0
+                figure) or 'Div'
+          value - the content of the figure
+          fmt - the output format ('tex', 'html', ...)
+        """
 
-    for name in ['xnos-capitalise', 'xnos-capitalize']:
-        # 'xnos-capitalise' enables capitalise in all 3 of
-        # fignos/eqnos/tablenos.  Since this uses an option in the caption
-        # package, it is not possible to select between the three (use
-        # 'fignos-plus-name' instead.  'xnos-capitalize' is an alternative
-        # spelling
-        if name in meta:
-            capitalise = check_bool(get_meta(meta, name))
-            break
 
-    if 'fignos-plus-name' in meta:
-        tmp = get_meta(meta, 'fignos-plus-name')
-        old_plusname = copy.deepcopy(plusname)
-        if isinstance(tmp, list):  # The singular and plural forms were given
-            plusname = tmp
-        else:  # Only the singular form was given
-            plusname[0] = tmp
-        plusname_changed = plusname != old_plusname
-        assert len(plusname) == 2
-        for name in plusname:
-            assert isinstance(name, STRTYPES)
-        if plusname_changed:
-            starname = [name.title() for name in plusname]
-
-    if 'fignos-star-name' in meta:
-        tmp = get_meta(meta, 'fignos-star-name')
-        old_starname = copy.deepcopy(starname)
-        if isinstance(tmp, list):
-            starname = tmp
+        if self.counting:
+            self.profile.count('figures')
+
+        # Initialize the return value
+        fig = {'key': key,
+               'is_unnumbered': False,
+               'is_unreferenceable': False,
+               'is_tagged': False}
+
+        # Bail out if there are no attributes
+        if key == 'Para' and len(value[0]['c']) == 2:
+            self.has_unnumbered_figures = True
+            fig.update({'is_unnumbered': True, 'is_unreferenceable': True})
+            if self.manifest is not None:
+                self._log_figure(key, value)
+            return fig
+
+        # Parse the figure
+        attrs = fig['attrs'] = \
+          PandocAttributes(value[0]['c'][0] if key == 'Para' else value[0],
+                           'pandoc')
+        fig['caption'] = value[0]['c'][1] if key == 'Para' else \
+          _figure_caption(value) if key == 'Figure' else None
+
+        # Bail out if the label does not conform to expectations
+        if not LABEL_PATTERN.match(attrs.id):
+            self.has_unnumbered_figures = True
+            fig.update({'is_unnumbered': True, 'is_unreferenceable': True})
+            if self.manifest is not None:
+                self._log_figure(key, value)
+            return fig
+
+        # Identify unreferenceable figures
+        if attrs.id == 'fig:':
+            fig['is_unreferenceable'] = True
+
+        # Pandoc >= 3.0 leaves the attributes other than the id with the
+        # image
+        if key == 'Figure' and 'tag' not in attrs:
+            image = _figure_image(value)
+            if image is not None:
+                image_attrs = PandocAttributes(image['c'][0], 'pandoc')
+                if 'tag' in image_attrs:
+                    attrs['tag'] = image_attrs['tag']
+
+        # Update the current section number.  Section numbers are only
+        # inserted into the attributes when they are needed; Figures are
+        # numbered from the section tracker directly.
+        if not self.config.secnos:  # They may be tracked for the manifest
+            secno = None
+        elif key == 'Figure':
+            # pylint: disable=protected-access
+            secno = pandocxnos.core._sec
         else:
-            starname[0] = tmp
-        starname_changed = starname != old_starname
-        assert len(starname) == 2
-        for name in starname:
-            assert isinstance(name, STRTYPES)
-
-    for name in ['fignos-number-by-section', 'xnos-number-by-section']:
-        if name in meta:
-            numbersections = check_bool(get_meta(meta, name))
-            break
+            secno = attrs['secno'] if 'secno' in attrs else None
+        if secno != self.cursec:  # The section number changed
+            self.cursec = secno   # Update the section tracker
+            if self.config.numbersections:
+                self.Ntargets = 0          # Resets the target counter
+
+        # Increment the targets and figures counters
+        if 'tag' not in attrs:
+            self.Ntargets += 1
+        self.Nfigures += 1
+
+        # Pandoc's --number-sections supports section numbering latex/pdf,
+        # html, epub, and docx
+        if self.config.tag_secnos and 'tag' not in attrs:
+            attrs['tag'] = str(self.cursec+self.config.secoffset) + '.' + \
+              str(self.Ntargets)
+
+        # Update the targets tracker
+        fig['is_tagged'] = 'tag' in attrs
+        if fig['is_tagged']:  # Remove any surrounding quotes
+            if attrs['tag'][0] == '"' and attrs['tag'][-1] == '"':
+                attrs['tag'] = attrs['tag'].strip('"')
+            elif attrs['tag'][0] == "'" and attrs['tag'][-1] == "'":
+                attrs['tag'] = attrs['tag'].strip("'")
+        if fig['is_unreferenceable']:  # Give it an id of its own
+            attrs.id += self._make_id(attrs['tag'] if fig['is_tagged'] \
+                                        else None)
+        if fig['is_tagged']:  # ... then save the tag
+            self.targets[attrs.id] = pandocxnos.Target(
+                attrs['tag'], self.cursec, attrs.id in self.targets)
+        else:  # ... then save the figure number
+            self.targets[attrs.id] = pandocxnos.Target(
+                self.Ntargets, self.cursec, attrs.id in self.targets)
+        fig['num'] = self.targets[attrs.id].num
+        if self.target_log is not None:
+            self.target_log.append([attrs.id, fig['num'], self.cursec])
+        if self.manifest is not None:
+            self._log_figure(key, value, attrs.id, fig['num'])
+
+        return fig
 
-    if 'xnos-number-offset' in meta:
-        secoffset = int(get_meta(meta, 'xnos-number-offset'))
-
-def add_tex(meta):
-    """Adds tex to the meta data."""
-
-    # pylint: disable=too-many-boolean-expressions
-    warnings = warninglevel == 2 and targets and \
-      (pandocxnos.cleveref_required() or has_unnumbered_figures or
-       plusname_changed or starname_changed or has_tagged_figures or
-       captionname_changed or numbersections or secoffset)
-    if warnings:
-        msg = textwrap.dedent("""\
-                  pandoc-fignos: Wrote the following blocks to
-                  header-includes.  If you use pandoc's
-                  --include-in-header option then you will need to
-                  manually include these yourself.
-              """)
-        STDERR.write('\n')
-        STDERR.write(textwrap.fill(msg))
-        STDERR.write('\n')
-
-    # Update the header-includes metadata.  Pandoc's
-    # --include-in-header option will override anything we do here.  This
-    # is a known issue and is owing to a design decision in pandoc.
-    # See https://github.com/jgm/pandoc/issues/3139.
-
-    if pandocxnos.cleveref_required() and targets:
-        tex = """
-            %%%% pandoc-fignos: required package
-            \\usepackage%s{cleveref}
-        """ % ('[capitalise]' if capitalise else '')
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', tex, regex=r'\\usepackage(\[[\w\s,]*\])?\{cleveref\}')
-
-    if has_unnumbered_figures or (separator_changed and targets):
-        tex = """
-            %%%% pandoc-fignos: required package
-            \\usepackage{caption}
+    def _log_figure(self, key, value, label=None, num=None):
+        """Adds the figure to the manifest.  Div figures have no image or
+        caption of their own.  The section number is taken from pandocxnos,
+        which tracks it for the manifest even when the figures are not
+        numbered by section."""
+        image = caption = None
+        if key == 'Para':
+            image = value[0]['c'][-1][0]
+            caption = stringify(value[0]['c'][-2])
+        elif key == 'Figure':
+            image = _figure_image(value)
+            image = image['c'][-1][0] if image is not None else None
+            caption = stringify(value[1][1])
+        # pylint: disable=protected-access
+        self.manifest.add_figure(label, num, pandocxnos.core._sec, image,
+                                 caption)
+
+    def _log_references(self, labels):
+        """Adds the references to `labels` to the manifest, if there is
+        one."""
+        if self.manifest is not None:
+            self.manifest.add_references(labels, self.targets)
+
+    def _make_id(self, tag=None):
+        """Returns an id for an unreferenceable figure with the tag `tag`,
+        or else the current figure number.  The id is derived from the
+        tag or number and the count of figures so far, so that the output
+        is the same from run to run and no two figures share an id."""
+        import uuid
+        name = 'tag %s' % tag if tag is not None else \
+          'figure %s.%s' % (self.cursec, self.Ntargets)
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, 'pandoc-fignos:%s #%d' % \
+                              (name, self.Nfigures)))
+
+    def _adjust_caption(self, fmt, fig, value):
+        """Adjusts the caption."""
+        if not fig['is_unnumbered']:
+            self.backend.adjust_caption(fig, value)
+
+    def _add_markup(self, fmt, fig, value):
+        """Adds markup to the output."""
+        if fig['is_tagged']:
+            self.has_tagged_figures = True
+        return self.backend.add_markup(fig, value)
+
+    # pylint: disable=unused-argument
+    def process_figures(self, key, value, fmt, meta):
+        """Processes the figures."""
+
+        # Process figures wrapped in Para elements
+        if key == 'Para' and len(value) == 1 and \
+          value[0]['t'] == 'Image' and value[0]['c'][-1][1].startswith('fig:'):
+
+            # Process the figure and add markup
+            fig = self._process_figure(key, value, fmt)
+            if 'attrs' in fig:
+                self._adjust_caption(fmt, fig, value)
+            return self._add_markup(fmt, fig, value)
+
+        # Process pandoc >= 3.0 Figure blocks
+        if key == 'Figure':
+            fig = self._process_figure(key, value, fmt)
+            if 'attrs' in fig:
+                self._adjust_caption(fmt, fig, value)
+            return self._add_markup(fmt, fig, value)
+
+        if key == 'Div' and LABEL_PATTERN.match(value[0][0]):
+            fig = self._process_figure(key, value, fmt)
+
+        return None
+
+    # pylint: disable=unused-argument
+    def count_figures(self, key, value, fmt, meta):
+        """Numbers the figures without adjusting their captions or adding
+        markup."""
+        if (key == 'Para' and len(value) == 1 and value[0]['t'] == 'Image' \
+            and value[0]['c'][-1][1].startswith('fig:')) or \
+          key == 'Figure' or \
+          (key == 'Div' and LABEL_PATTERN.match(value[0][0])):
+            self._process_figure(key, value, fmt)
+
+
+    # pylint: disable=too-many-branches,too-many-statements
+    def process(self, meta):
+        """Saves metadata fields in the filter variables and returns a few
+        computed fields."""
+
+
+        # Read in the metadata fields and do some checking
+
+        for name in ['fignos-warning-level', 'xnos-warning-level']:
+            if name in meta:
+                self.warninglevel = int(get_meta(meta, name))
+                pandocxnos.set_warning_level(self.warninglevel)
+                break
+
+        metanames = ['fignos-warning-level', 'xnos-warning-level',
+                     'fignos-caption-name',
+                     'fignos-caption-separator', 'xnos-caption-separator',
+                     'fignos-cleveref', 'xnos-cleveref',
+                     'xnos-capitalise', 'xnos-capitalize',
+                     'fignos-plus-name', 'fignos-star-name',
+                     'fignos-number-by-section', 'xnos-number-by-section',
+                     'xnos-number-offset', 'fignos-chapter']
+
+        if self.warninglevel:
+            for name in meta:
+                if (name.startswith('fignos') or name.startswith('xnos')) and \
+                  name not in metanames:
+                    import textwrap
+                    msg = textwrap.dedent("""
+                              pandoc-fignos: unknown meta variable "%s"
+                          """ % name)
+                    STDERR.write(msg)
+
+        if 'fignos-caption-name' in meta:
+            old_captionname = self.captionname
+            self.captionname = get_meta(meta, 'fignos-caption-name')
+            self.captionname_changed = self.captionname != old_captionname
+            assert isinstance(self.captionname, STRTYPES)
+
+        for name in ['fignos-caption-separator', 'xnos-caption-separator']:
+            if name in meta:
+                old_separator = self.separator
+                self.separator = get_meta(meta, name)
+                if self.separator not in SEPARATORS:
+                    import textwrap
+                    msg = textwrap.dedent("""
+                              pandoc-fignos: caption separator must be one of
+                              none, colon, period, space, quad, or newline.
+                          """ % name)
+                    STDERR.write(msg)
+                    continue
+                self.separator_changed = self.separator != old_separator
+                break
+
+        for name in ['fignos-cleveref', 'xnos-cleveref']:
+            # 'xnos-cleveref' enables cleveref in all 3 of
+            # fignos/eqnos/tablenos
+            if name in meta:
+                self.cleveref = check_bool(get_meta(meta, name))
+                break
+
+        for name in ['xnos-capitalise', 'xnos-capitalize']:
+            # 'xnos-capitalise' enables capitalise in all 3 of
+            # fignos/eqnos/tablenos.  Since this uses an option in the caption
+            # package, it is not possible to select between the three (use
+            # 'fignos-plus-name' instead.  'xnos-capitalize' is an alternative
+            # spelling
+            if name in meta:
+                self.capitalise = check_bool(get_meta(meta, name))
+                break
+
+        if 'fignos-plus-name' in meta:
+            tmp = get_meta(meta, 'fignos-plus-name')
+            old_plusname = list(self.plusname)
+            if isinstance(tmp, list):  # The singular and plural forms given
+                self.plusname = tmp
+            else:  # Only the singular form was given
+                self.plusname[0] = tmp
+            self.plusname_changed = self.plusname != old_plusname
+            assert len(self.plusname) == 2
+            for name in self.plusname:
+                assert isinstance(name, STRTYPES)
+            if self.plusname_changed:
+                self.starname = [name.title() for name in self.plusname]
+
+        if 'fignos-star-name' in meta:
+            tmp = get_meta(meta, 'fignos-star-name')
+            old_starname = list(self.starname)
+            if isinstance(tmp, list):
+                self.starname = tmp
+            else:
+                self.starname[0] = tmp
+            self.starname_changed = self.starname != old_starname
+            assert len(self.starname) == 2
+            for name in self.starname:
+                assert isinstance(name, STRTYPES)
+
+        for name in ['fignos-number-by-section', 'xnos-number-by-section']:
+            if name in meta:
+                self.numbersections = check_bool(get_meta(meta, name))
+                break
+
+        if 'xnos-number-offset' in meta:
+            self.secoffset = int(get_meta(meta, 'xnos-number-offset'))
+
+        if 'fignos-chapter' in meta:
+            self.chapter = str(get_meta(meta, 'fignos-chapter'))
+
+    def add_tex(self, meta):
+        """Adds tex to the meta data."""
+
+        # pylint: disable=too-many-boolean-expressions
+        warnings = self.warninglevel == 2 and self.targets and \
+          (pandocxnos.cleveref_required() or self.has_unnumbered_figures or
+           self.plusname_changed or self.starname_changed or
+           self.has_tagged_figures or self.captionname_changed or
+           self.numbersections or self.secoffset)
+        if warnings:
+            import textwrap
+            msg = textwrap.dedent("""\
+                      pandoc-fignos: Wrote the following blocks to
+                      header-includes.  If you use pandoc's
+                      --include-in-header option then you will need to
+                      manually include these yourself.
+                  """)
+            STDERR.write('\n')
+            STDERR.write(textwrap.fill(msg))
+            STDERR.write('\n')
+
+        # Update the header-includes metadata.  Pandoc's
+        # --include-in-header option will override anything we do here.  This
+        # is a known issue and is owing to a design decision in pandoc.
+        # See https://github.com/jgm/pandoc/issues/3139.
+
+        if pandocxnos.cleveref_required() and self.targets:
+            tex = """
+                %%%% pandoc-fignos: required package
+                \\usepackage%s{cleveref}
+            """ % ('[capitalise]' if self.capitalise else '')
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', tex,
+                regex=r'\\usepackage(\[[\w\s,]*\])?\{cleveref\}')
+
+        if self.has_unnumbered_figures or \
+          (self.separator_changed and self.targets):
+            tex = """
+                %%%% pandoc-fignos: required package
+                \\usepackage{caption}
+            """
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', tex,
+                regex=r'\\usepackage(\[[\w\s,]*\])?\{caption\}')
+
+        if self.plusname_changed and self.targets:
+            tex = """
+                %%%% pandoc-fignos: change cref names
+                \\crefname{figure}{%s}{%s}
+            """ % (self.plusname[0], self.plusname[1])
+            pandocxnos.add_to_header_includes(meta, 'tex', tex)
+
+        if self.starname_changed and self.targets:
+            tex = """
+                %%%% pandoc-fignos: change Cref names
+                \\Crefname{figure}{%s}{%s}
+            """ % (self.starname[0], self.starname[1])
+            pandocxnos.add_to_header_includes(meta, 'tex', tex)
+
+        if self.has_unnumbered_figures:
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', NO_PREFIX_CAPTION_ENV_TEX)
+
+        if self.has_tagged_figures and self.targets:
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', TAGGED_FIGURE_ENV_TEX)
+
+        if self.captionname_changed and self.targets:
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', CAPTION_NAME_TEX % self.captionname)
+
+        if self.separator_changed and self.targets:
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', CAPTION_SEPARATOR_TEX % self.separator)
+
+        if self.numbersections and self.targets:
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', NUMBER_BY_SECTION_TEX)
+
+        if self.secoffset and self.targets:
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', SECOFFSET_TEX % self.secoffset,
+                regex=r'\\setcounter\{section\}')
+
+        if warnings:
+            STDERR.write('\n')
+
+    def init(self, pandocversion, doc, initialized=False):
+        """Initializes pandocxnos and the element primitives for the pandoc
+        version.  `doc` need only contain the 'pandoc-api-version' field
+        (if any).  If `initialized` is True, pandocxnos has already been
+        initialized for the document (e.g., by run_chain()), and
+        `pandocversion` is the version that was returned; only the state
+        of pandocxnos is reset.  Returns the pandoc version."""
+
+        # Initialize pandocxnos.  Its record of reported bad references is
+        # not reset by init() and must be cleared for each document.
+        if initialized:
+            self.pandocversion = pandocversion
+            # pylint: disable=protected-access
+            pandocxnos.core._sec = 0
+            pandocxnos.core._cleveref_flag = None
+        else:
+            self.pandocversion = init_pandocxnos(pandocversion, doc,
+                                                 self.verbose)
+        pandocxnos.set_warning_level(self.warninglevel)
+        del pandocxnos.core.badlabels[:]
+
+        # Element primitives
+        if version(self.pandocversion) < version('1.16'):
+            self.Image = elt('Image', 2)
+
+        return self.pandocversion
+
+    def configure(self, fmt):
+        """Sets the Config and Backend for the output format `fmt`.  This
+        must be called after init() and process()."""
+        self.config = make_config(fmt, self.pandocversion, self.captionname,
+                                  self.separator, self.numbersections,
+                                  self.secoffset)
+        self.backend = BACKENDS.get(self.config.family, Backend)(self.config)
+        return self.config
+
+    def use_index(self):
+        """Starts the numbering where the chapter starts in the target
+        index, and adds the targets in the other chapters.  This must be
+        called after process()."""
+        chapter = self.chapter or self.index.chapter
+        start = self.index.start(chapter)
+        if start is None:
+            if self.warninglevel:
+                STDERR.write('\npandoc-fignos: %s\n' % \
+                             ('Chapter "%s" is not in the target index.' % \
+                              chapter if chapter else \
+                              'Set fignos-chapter to use the target index.'))
+                STDERR.flush()
+            return
+        self._set_state(start)
+        for label, (num, secno, name) in self.index.targets.items():
+            if name != chapter:
+                self.targets[label] = pandocxnos.Target(num, secno, False)
+
+    def collect(self, chapters, fmt, pandocversion=None):
+        """Numbers the figures in the `chapters` of a book as though they
+        were one document, for the output format `fmt`.  The chapters are
+        given as (name, doc) pairs in book order.  Returns a TargetIndex
+        of the chapters and their targets."""
+        index = TargetIndex()
+        with _XNOS_LOCK:
+            self.reset()
+            state = None
+            for name, doc in chapters:
+                self.init(pandocversion, doc)
+                meta = top_level(doc)[1]
+                self.process(meta)
+                config = self.configure(fmt)
+                blocks = doc['blocks'] if config.api else doc[1:]
+                if state is not None:  # Continue from the previous chapter
+                    self._set_state(state)
+                start = self._state()
+                self.target_log = []
+                apply_first_pass(index_document(blocks, not config.api)
+                                 ['figures'], self.make_first_pass(), fmt,
+                                 meta)
+                index.add_chapter(name, start, self.target_log)
+                self.target_log = None
+                state = self._state()
+        return index
+
+    def tracks_sections(self):
+        """Returns True if the first pass tracks the section numbers; i.e.,
+        if figures are numbered by section, for epub (whose chapters are
+        sections) or for the manifest."""
+        return self.config.secnos or self.manifest is not None
+
+    def make_first_pass(self, process_figures=None):
+        """Returns the first_pass action.  The figures are processed by
+        the `process_figures` action, which defaults to
+        self.process_figures()."""
+        if self.config.figure_blocks:  # Figures have their own attributes
+            attach_attrs_image = detach_attrs_image = None
+        else:
+            attach_attrs_image = attach_attrs_factory(
+                self.Image, extract_attrs=self._extract_attrs,
+                replace=self.config.image_attrs)
+            detach_attrs_image = detach_attrs_factory(self.Image)
+        if self.tracks_sections():
+            insert_secnos_img = insert_secnos_factory(self.Image)
+            delete_secnos_img = delete_secnos_factory(self.Image)
+            insert_secnos_div = insert_secnos_factory(Div)
+            delete_secnos_div = delete_secnos_factory(Div)
+        else:
+            insert_secnos_img = delete_secnos_img = None
+            insert_secnos_div = delete_secnos_div = None
+        first_pass = first_pass_factory(process_figures or \
+                                          self.process_figures,
+                                        attach_attrs_image, detach_attrs_image,
+                                        insert_secnos_img, delete_secnos_img,
+                                        insert_secnos_div, delete_secnos_div)
+        if self.counting:
+            first_pass = self.profile.counter('first_pass_nodes', first_pass)
+        return first_pass
+
+    def make_second_pass(self, labels=None):
+        """Returns the second_pass action and the post action that attaches
+        Span attributes.  This must be called after the first pass (and
+        always, because the factories flag whether or not cleveref is
+        required).  The labels of the references that are replaced are
+        appended to the list `labels`, if one is given."""
+        process_refs = process_refs_factory(LABEL_PATTERN,
+                                            self.targets.keys())
+        replace_refs = replace_refs_factory(
+            self.targets, self.cleveref, False,
+            self.plusname if not self.capitalise or self.plusname_changed \
+              else [name.title() for name in self.plusname],
+            self.starname)
+        replace_refs = memoize_refs_factory(
+            replace_refs, self.targets, self.rendered,
+            self.profile.count if self.counting else None)
+        attach_attrs_span = attach_attrs_factory(Span, replace=True)
+        if self.counting:
+            replace_refs = self.profile.counter('references', replace_refs,
+                                                changes=True)
+        if labels is not None:
+            replace_refs = self._record_labels(replace_refs, labels)
+        second_pass = second_pass_factory(process_refs, replace_refs)
+        if self.counting:
+            second_pass = self.profile.counter('second_pass_nodes',
+                                               second_pass)
+        return second_pass, attach_attrs_span
+
+    @staticmethod
+    def _record_labels(replace_refs, labels):
+        """Returns the `replace_refs` action wrapped so that the labels of
+        the references it replaces are appended to `labels`."""
+        def recorded(key, value, fmt, meta):
+            """Records the label and replaces the reference."""
+            if key == 'Cite' and len(value) == 3:
+                labels.append(value[-2][0]['citationId'])
+            return replace_refs(key, value, fmt, meta)
+        return recorded
+
+    def filter_stream(self, reader, stdout, fmt, pandocversion=None):
+        """Filters a pandoc >= 1.18 document read by the JSONReader `reader`
+        block by block, and writes it to `stdout`.  The filter is reset
+        first.
+
+        The blocks are streamed through a temporary spool file between the
+        passes so that references to later figures can be resolved.  Only
+        the metadata, the figure targets and one block at a time are held
+        in memory, provided the metadata comes before the blocks (as pandoc
+        writes it).  The metadata is written last because the
+        header-includes can only be completed once the references are
+        processed.
         """
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', tex, regex=r'\\usepackage(\[[\w\s,]*\])?\{caption\}')
-
-    if plusname_changed and targets:
-        tex = """
-            %%%% pandoc-fignos: change cref names
-            \\crefname{figure}{%s}{%s}
-        """ % (plusname[0], plusname[1])
-        pandocxnos.add_to_header_includes(meta, 'tex', tex)
-
-    if starname_changed and targets:
-        tex = """
-            %%%% pandoc-fignos: change Cref names
-            \\Crefname{figure}{%s}{%s}
-        """ % (starname[0], starname[1])
-        pandocxnos.add_to_header_includes(meta, 'tex', tex)
-
-    if has_unnumbered_figures:
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', NO_PREFIX_CAPTION_ENV_TEX)
-
-    if has_tagged_figures and targets:
-        pandocxnos.add_to_header_includes(meta, 'tex', TAGGED_FIGURE_ENV_TEX)
-
-    if captionname_changed and targets:
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', CAPTION_NAME_TEX % captionname)
-
-    if separator_changed and targets:
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', CAPTION_SEPARATOR_TEX % separator)
-
-    if numbersections and targets:
-        pandocxnos.add_to_header_includes(meta, 'tex', NUMBER_BY_SECTION_TEX)
-
-    if secoffset and targets:
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', SECOFFSET_TEX % secoffset,
-            regex=r'\\setcounter\{section\}')
-
-    if warnings:
-        STDERR.write('\n')
-
-# pylint: disable=too-many-locals, unused-argument
-def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
-    """Filters the document AST."""
+        with _XNOS_LOCK:
+            self.reset()
+            self._filter_stream(reader, stdout, fmt, pandocversion)
+
+    # pylint: disable=too-many-locals
+    def _filter_stream(self, reader, stdout, fmt, pandocversion):
+        """Does the work for filter_stream()."""
+
+        # Read the document up to the blocks.  The blocks are streamed if the
+        # metadata has been read; otherwise they are decoded as a whole.
+        parts = []  # (key, value) pairs for the fields other than the blocks
+        blocks = None
+        reader.expect('{')
+        while reader.peek() != '}':
+            key = reader.value()
+            reader.expect(':')
+            if key == 'blocks' and 'meta' in dict(parts):
+                blocks = reader.items()
+                break
+            parts.append((key, reader.value()))
+            if reader.peek() == ',':
+                reader.pos += 1
+        if blocks is None:
+            blocks = iter(dict(parts).get('blocks', []))
+            parts = [(key, value) for key, value in parts if key != 'blocks']
+
+        # Initialize and process the metadata variables
+        with self.profile.stage('init'):
+            self.init(pandocversion, dict(parts))
+        meta = dict(parts).get('meta', {})
+        with self.profile.stage('process'):
+            self.process(meta)
+            config = self.configure(fmt)
+            if self.index is not None:
+                self.use_index()
+
+        if self.verbose:
+            report_plan({'first_pass': True, 'second_pass': True,
+                         'passthrough': False}, self.tracks_sections())
+
+        # First pass; spool the processed blocks as json lines.  The time
+        # includes decoding the blocks and spooling them.
+        import tempfile
+        spool = tempfile.TemporaryFile('w+')
+        first_pass = self.make_first_pass()
+        links = not config.api
+        with self.profile.stage('first_pass'):
+            for block in blocks:
+                x = [block]
+                apply_first_pass(index_document(x, links)['figures'],
+                                 first_pass, fmt, meta)
+                for el in x:
+                    spool.write(json.dumps(el))
+                    spool.write('\n')
+
+        # Read any fields that follow the blocks
+        while reader.peek() == ',':
+            reader.pos += 1
+            key = reader.value()
+            reader.expect(':')
+            parts.append((key, reader.value()))
+
+        # Second pass; write the blocks as they are processed
+        labels = [] if self.manifest is not None else None
+        second_pass, attach_attrs_span = self.make_second_pass(labels)
+        spool.seek(0)
+        stdout.write('{')
+        for key, value in parts:
+            if key != 'meta':
+                stdout.write('%s: %s, ' % (json.dumps(key),
+                                           json.dumps(value)))
+        stdout.write('"blocks": [')
+        with self.profile.stage('second_pass'):  # Includes writing blocks
+            for i, line in enumerate(spool):
+                x = [json.loads(line)]
+                for _, el in index_document(x, links)['refs']:
+                    walk([el], second_pass, fmt, meta,
+                         post=attach_attrs_span)
+                if i:
+                    stdout.write(', ')
+                stdout.write(json.dumps(x[0]))
+        spool.close()
+        self._log_references(labels)
+
+        if config.family == 'latex':
+            with self.profile.stage('add_tex'):
+                self.add_tex(meta)
+
+        # Write the metadata last
+        stdout.write('], "meta": %s}' % json.dumps(meta))
+        stdout.flush()
+
+    # pylint: disable=too-many-arguments
+    def filter(self, doc, fmt, pandocversion=None, plan=None, cache=None,
+               jobs=None, initialized=False):
+        """Filters the document AST dict (or list, for pandoc < 1.18) `doc`
+        for the output format `fmt`.  The filter is reset first.  Returns
+        the filtered doc.
+
+        Parameters:
+
+          doc - the document AST; it is modified in place
+          fmt - the output format ('latex', 'html', ...)
+          pandocversion - the pandoc version (optional)
+          plan - the plan from plan_passes() (optional; all passes are
+                 done by default)
+          cache - a BlockCache to reuse filtered blocks from (optional)
+          jobs - the number of processes to filter the sections with in
+                 parallel (optional; 0 for one per CPU); not used with a
+                 cache
+          initialized - flags that pandocxnos has already been initialized
+                        for the document (see init())
+        """
+        if plan is None:
+            plan = {'first_pass': True, 'second_pass': True,
+                    'passthrough': False}
+
+        with _XNOS_LOCK:
+
+            # Initialize
+            with self.profile.stage('init'):
+                self.reset()
+                self.init(pandocversion, doc, initialized)
+
+            # Process the metadata variables and compile the configuration
+            with self.profile.stage('process'):
+                meta = top_level(doc)[1]
+                self.process(meta)
+                config = self.configure(fmt)
+                if self.index is not None:
+                    self.use_index()
+
+            # Chop up the doc
+            blocks = doc['blocks'] if config.api else doc[1:]
+
+            if self.verbose:
+                report_plan(plan, self.tracks_sections())
+
+            if cache is not None:
+                self._filter_cached(blocks if config.api else blocks[0],
+                                    fmt, meta, plan, cache)
+            elif jobs is not None:
+                self._filter_parallel(blocks if config.api else blocks[0],
+                                      fmt, meta, plan, jobs)
+            else:
 
-    # pylint: disable=global-statement
-    global PANDOCVERSION
-    global Image
+                # Index the elements that the passes act on
+                with self.profile.stage('index'):
+                    index = index_document(blocks, not config.api)
+
+                # First pass
+                if plan['first_pass']:
+                    with self.profile.stage('first_pass'):
+                        apply_first_pass(index['figures'],
+                                         self.make_first_pass(), fmt, meta)
+
+                # Second pass
+                with self.profile.stage('second_pass'):
+                    labels = [] if self.manifest is not None else None
+                    second_pass, attach_attrs_span = \
+                      self.make_second_pass(labels)
+                    if plan['second_pass']:
+                        for _, el in index['refs']:
+                            walk([el], second_pass, fmt, meta,
+                                 post=attach_attrs_span)
+                    self._log_references(labels)
+
+            if config.family == 'latex':
+                with self.profile.stage('add_tex'):
+                    self.add_tex(meta)
+
+            # Update the doc
+            if not config.api:
+                doc[1:] = blocks
+
+        return doc
+
+    # pylint: disable=protected-access
+
+    def _state(self):
+        """Returns the numbering state that the first pass carries from
+        block to block."""
+        return [pandocxnos.core._sec, self.cursec, self.Ntargets,
+                self.Nfigures]
+
+    def _set_state(self, state):
+        """Sets the numbering state."""
+        pandocxnos.core._sec, self.cursec, self.Ntargets, self.Nfigures = \
+          state
+
+    def _target(self, label):
+        """Returns the target for `label` as a list, or None."""
+        target = self.targets.get(label)
+        return list(target) if target else None
+
+    # pylint: disable=too-many-locals,too-many-arguments
+    def _first_pass_block(self, x, index, first_pass, fmt, meta):
+        """Applies the first pass to the block list `x` with the given
+        `index`.  Returns a cache entry for the result."""
+        flags = [self.has_unnumbered_figures, self.has_tagged_figures]
+        self.has_unnumbered_figures = self.has_tagged_figures = False
+        self.target_log = []
+        manifest, self.manifest = self.manifest, Manifest()  # Always logged
+        with _capture_messages() as buf:
+            apply_first_pass(index['figures'], first_pass, fmt, meta)
+        STDERR.write(buf.getvalue())
+        entry = {'blocks': x,
+                 'refs': bool(index_document(x, not self.config.api)['refs']),
+                 'state': self._state(), 'targets': self.target_log,
+                 'figures': self.manifest.figures,
+                 'flags': [self.has_unnumbered_figures,
+                           self.has_tagged_figures],
+                 'messages': buf.getvalue()}
+        self.target_log = None
+        self.manifest = manifest
+        if manifest is not None:
+            manifest.figures.extend(entry['figures'])
+        self.has_unnumbered_figures = self.has_unnumbered_figures or flags[0]
+        self.has_tagged_figures = self.has_tagged_figures or flags[1]
+        return entry
+
+    def _restore_first_pass(self, entry):
+        """Restores the effects of the first pass from a cache entry."""
+        self._set_state(entry['state'])
+        for label, num, secno in entry['targets']:
+            self.targets[label] = pandocxnos.Target(num, secno,
+                                                    label in self.targets)
+        self.has_unnumbered_figures = \
+          self.has_unnumbered_figures or entry['flags'][0]
+        self.has_tagged_figures = self.has_tagged_figures or entry['flags'][1]
+        if self.manifest is not None:
+            self.manifest.figures.extend(entry['figures'])
+        STDERR.write(entry['messages'])
+
+    # pylint: disable=too-many-arguments
+    def _second_pass_block(self, x, second_pass, post, labels, fmt, meta):
+        """Applies the second pass to the block list `x`.  The labels of
+        the replaced references are recorded in `labels`.  Returns a cache
+        entry for the result, or None if it should not be cached."""
+        del labels[:]
+        flag = pandocxnos.core._cleveref_flag
+        pandocxnos.core._cleveref_flag = None  # Detects cleveref modifiers
+        with _capture_messages() as buf:
+            for _, el in index_document(x, not self.config.api)['refs']:
+                walk([el], second_pass, fmt, meta, post=post)
+        STDERR.write(buf.getvalue())
+        cleveref = bool(pandocxnos.core._cleveref_flag)
+        pandocxnos.core._cleveref_flag = flag or cleveref or None
+        deps = [[label, self._target(label)] for label in labels]
+        if any(target is None and LABEL_PATTERN.match(label)
+               for label, target in deps):
+            return None  # Bad references are only reported once
+        return {'blocks': x, 'deps': deps, 'cleveref': cleveref,
+                'messages': buf.getvalue()}
+
+    def _restore_second_pass(self, entry):
+        """Restores the effects of the second pass from a cache entry."""
+        if entry['cleveref']:
+            pandocxnos.core._cleveref_flag = True
+        STDERR.write(entry['messages'])
+
+    # pylint: enable=protected-access
+
+    # pylint: disable=too-many-arguments
+    def _filter_cached(self, blocks, fmt, meta, plan, cache):
+        """Does the passes for filter() one top-level block at a time,
+        reusing the filtered blocks in the BlockCache `cache` where
+        possible.  The list `blocks` is updated in place.
+
+        The first pass output for a block is reused if the block, the
+        settings and the numbering state entering the block are unchanged.
+        The second pass output is reused if its input and the settings are
+        unchanged, and the targets of its references have not changed.
+        """
+        links = not self.config.api
+        settings = cache.key(CACHE_FORMAT, __version__, self.config, meta,
+                             self.tracks_sections())
+
+        # First pass.  Blocks that have no figures or headers are passed
+        # over.
+        done = []  # (block list, flags refs) for each block
+        with self.profile.stage('first_pass'):
+            first_pass = self.make_first_pass()
+            for block in blocks:
+                x = [block]
+                index = index_document(x, links)
+                if not (plan['first_pass'] and index['figures']):
+                    done.append((x, bool(index['refs'])))
+                    continue
+                key = cache.key(settings, 'first_pass', self._state(), block)
+                entry = cache.get(key)
+                if entry is None:
+                    cache.count('first_pass_misses')
+                    entry = self._first_pass_block(x, index, first_pass, fmt,
+                                                   meta)
+                    cache.put(key, entry)
+                else:
+                    cache.count('first_pass_hits')
+                    self._restore_first_pass(entry)
+                done.append((entry['blocks'], entry['refs']))
+
+        # Second pass.  Blocks without references are passed over.
+        with self.profile.stage('second_pass'):
+            labels = []
+            second_pass, attach_attrs_span = self.make_second_pass(labels)
+            del blocks[:]
+            for x, refs in done:
+                if plan['second_pass'] and refs:
+                    key = cache.key(settings, 'second_pass', x)
+                    entry = cache.get(key)
+                    if entry is not None and \
+                      all(self._target(label) == target
+                          for label, target in entry['deps']):
+                        cache.count('second_pass_hits')
+                        self._restore_second_pass(entry)
+                        x = entry['blocks']
+                        self._log_references(label for label, _ in
+                                             entry['deps'])
+                    else:
+                        cache.count('second_pass_misses')
+                        entry = self._second_pass_block(
+                            x, second_pass, attach_attrs_span, labels, fmt,
+                            meta)
+                        if entry is not None:
+                            cache.put(key, entry)
+                        self._log_references(labels)
+                blocks.extend(x)
+
+        with self.profile.stage('evict'):
+            cache.evict()
+        if self.verbose:
+            cache.report()
+        if self.counting:
+            for name, n in cache.stats.items():
+                self.profile.count('cache_' + name, n)
+
+    # pylint: disable=too-many-arguments,too-many-locals
+    def _filter_parallel(self, blocks, fmt, meta, plan, jobs):
+        """Does the passes for filter() on chunks of sections in a pool of
+        `jobs` processes.  The list `blocks` is updated in place.
+
+        Only the numbering is sequential.  It is done first by a count
+        pass over copies of the blocks that have figures.  The chunks are
+        then filtered independently from their starting numbering states
+        with the targets of the whole document, and are put back in order.
+        """
+        # pylint: disable=protected-access
+        links = not self.config.api
+        if not jobs:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        chunks = split_sections(blocks, 4*jobs)
+
+        # Count pass.  The messages are reported by the workers.
+        states = []
+        with self.profile.stage('count'), _capture_messages():
+            tops = set(entry[0][0] for entry in
+                       index_document(blocks, links)['figures']) \
+              if plan['first_pass'] else set()
+            counting, self.counting = self.counting, False  # See workers
+            count_pass = self.make_first_pass(self.count_figures)
+            for start, end in chunks:
+                states.append(self._state())
+                x = [json.loads(json.dumps(blocks[i]))
+                     for i in range(start, end) if i in tops]
+                apply_first_pass(index_document(x, links)['figures'],
+                                 count_pass, fmt, meta)
+            self.counting = counting
+
+        # Filter the chunks
+        targets = [[label] + list(target)
+                   for label, target in self.targets.items()]
+        tasks = [{'fmt': fmt, 'pandocversion': self.pandocversion,
+                  'meta': meta, 'plan': plan, 'state': state,
+                  'targets': targets, 'blocks': blocks[start:end],
+                  'counting': self.counting,
+                  'manifest': self.manifest is not None}
+                 for state, (start, end) in zip(states, chunks)]
+        with self.profile.stage('sections'):
+            try:
+                from concurrent.futures import ProcessPoolExecutor
+            except ImportError:  # Python 2 without the futures backport
+                results = [_filter_chunk(task) for task in tasks]
+            else:
+                if len(tasks) > 1 and jobs > 1:
+                    with ProcessPoolExecutor(jobs) as executor:
+                        results = list(executor.map(_filter_chunk, tasks))
+                else:
+                    results = [_filter_chunk(task) for task in tasks]
+
+        # Reassemble the document and restore the pandocxnos state.  Bad
+        # references are only reported once.
+        del blocks[:]
+        badlabels = pandocxnos.core.badlabels
+        del badlabels[:]
+        for result in results:
+            blocks.extend(result['blocks'])
+            messages = result['messages']
+            for label, msg in result['badrefs']:
+                if label in badlabels:
+                    messages = messages.replace(msg, '', 1)
+                else:
+                    badlabels.append(label)
+            STDERR.write(messages)
+            self.has_unnumbered_figures = \
+              self.has_unnumbered_figures or result['flags'][0]
+            self.has_tagged_figures = \
+              self.has_tagged_figures or result['flags'][1]
+            for name, n in result['counts'].items():
+                self.profile.count(name, n)
+            self._log_references(result['labels'])
+        pandocxnos.core._cleveref_flag = \
+          any(result['cleveref'] for result in results) or None
+        STDERR.flush()
 
-    # Read the command-line arguments
+
+# Main program ---------------------------------------------------------------
+
+class Arguments(object):  # pylint: disable=useless-object-inheritance
+    """The command-line arguments, for the common `pandoc-fignos FORMAT`
+    invocation.  These are parsed without argparse."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, fmt):
+        """Sets the output format `fmt` and the default options."""
+        self.fmt = fmt
+        self.pandocversion = None
+        self.verbose = False
+        self.stream = False
+        self.parallel = False
+        self.batch = False
+        self.jobs = None
+        self.dirs = []
+        self.profile = None
+        self.cprofile = False
+        self.cache = None
+        self.collect = False
+        self.index = None
+        self.manifest = None
+        self.stages = None
+        self.patch = False
+
+def parse_args(args=None):
+    """Parses the command-line arguments `args` (or sys.argv).  The
+    verbose, stream, parallel, profile, cache, index, manifest, stages and
+    patch options may also be set in the environment.  The stages are returned
+    as a list of names."""
+    if args is None:
+        args = sys.argv[1:]
+    if len(args) == 1 and not args[0].startswith('-'):  # The fast path
+        args = Arguments(args[0])
+    else:
+        args = _parse_args(args)
+    args.verbose = args.verbose or bool(os.environ.get('FIGNOS_VERBOSE'))
+    args.stream = args.stream or bool(os.environ.get('FIGNOS_STREAM'))
+    args.parallel = args.parallel or bool(os.environ.get('FIGNOS_PARALLEL'))
+    if not args.profile and os.environ.get('FIGNOS_PROFILE'):
+        # FIGNOS_PROFILE=1 reports to stderr; anything else is a file path
+        args.profile = os.environ['FIGNOS_PROFILE']
+        if args.profile == '1':
+            args.profile = '-'
+    args.cprofile = args.cprofile or bool(os.environ.get('FIGNOS_CPROFILE'))
+    args.cache = args.cache or os.environ.get('FIGNOS_CACHE') or None
+    args.index = args.index or os.environ.get('FIGNOS_INDEX') or None
+    args.manifest = args.manifest or os.environ.get('FIGNOS_MANIFEST') or None
+    args.stages = (args.stages or os.environ.get('FIGNOS_STAGES') or
+                   'fignos').split(',')
+    args.patch = args.patch or bool(os.environ.get('FIGNOS_PATCH'))
+    # The cache size limit is given in megabytes
+    args.cache_size = int(float(os.environ['FIGNOS_CACHE_SIZE']) * (1 << 20)) \
+      if os.environ.get('FIGNOS_CACHE_SIZE') else CACHE_SIZE
+    return args
+
+def _parse_args(args):
+    """Parses the command-line arguments `args` using argparse."""
+    import argparse
     parser = argparse.ArgumentParser(\
       description='Pandoc figure numbers filter.')
     parser.add_argument(\
@@ -598,72 +2686,623 @@ def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
       version='%(prog)s {version}'.format(version=__version__))
     parser.add_argument('fmt')
     parser.add_argument('--pandocversion', help='The pandoc version.')
-    args = parser.parse_args()
-
-    # Get the output format and document
-    fmt = args.fmt
-    doc = json.loads(stdin.read())
-
-    # Initialize pandocxnos
-    PANDOCVERSION = pandocxnos.init(args.pandocversion, doc)
-
-    # Element primitives
-    if version(PANDOCVERSION) < version('1.16'):
-        Image = elt('Image', 2)
-
-    # Chop up the doc
-    meta = doc['meta'] if version(PANDOCVERSION) >= version('1.18') \
-      else doc[0]['unMeta']
-    blocks = doc['blocks'] if version(PANDOCVERSION) >= version('1.18') \
-      else doc[1:]
-
-    # Process the metadata variables
-    process(meta)
-
-    # First pass
-    replace = version(PANDOCVERSION) >= version('1.16')
-    attach_attrs_image = attach_attrs_factory(Image,
-                                              extract_attrs=_extract_attrs,
-                                              replace=replace)
-    detach_attrs_image = detach_attrs_factory(Image)
-    insert_secnos_img = insert_secnos_factory(Image)
-    delete_secnos_img = delete_secnos_factory(Image)
-    insert_secnos_div = insert_secnos_factory(Div)
-    delete_secnos_div = delete_secnos_factory(Div)
-    altered = functools.reduce(lambda x, action: walk(x, action, fmt, meta),
-                               [attach_attrs_image,
-                                insert_secnos_img, insert_secnos_div,
-                                process_figures,
-                                delete_secnos_img, delete_secnos_div,
-                                detach_attrs_image], blocks)
-
-    # Second pass
-    process_refs = process_refs_factory(LABEL_PATTERN, targets.keys())
-    replace_refs = replace_refs_factory(targets, cleveref, False,
-                                        plusname if not capitalise \
-                                        or plusname_changed else
-                                        [name.title() for name in plusname],
-                                        starname)
-    attach_attrs_span = attach_attrs_factory(Span, replace=True)
-    altered = functools.reduce(lambda x, action: walk(x, action, fmt, meta),
-                               [repair_refs, process_refs, replace_refs,
-                                attach_attrs_span],
-                               altered)
-
-    if fmt in ['latex', 'beamer']:
-        add_tex(meta)
-
-    # Update the doc
-    if version(PANDOCVERSION) >= version('1.18'):
-        doc['blocks'] = altered
+    parser.add_argument('--verbose', action='store_true',
+                        help='Report processing details.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Filter the blocks one at a time.')
+    parser.add_argument('--parallel', action='store_true',
+                        help='Filter the sections in a pool of processes.')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE',
+                        help='Write a json profile of the stages to FILE '
+                        '(default stderr).')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='Add the hot functions to the profile.')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='Reuse the filtered blocks cached in DIR.')
+    parser.add_argument('--index', metavar='FILE',
+                        help='Resolve references to figures in other '
+                        'chapters using the target index FILE.')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='Write the figures and references to the json '
+                        '(or .csv) FILE.')
+    parser.add_argument('--patch', action='store_true',
+                        help='Write a json patch of the changes instead of '
+                        'the document.')
+    parser.add_argument('--collect', action='store_true',
+                        help='Collect the targets in the json chapter files '
+                        '(or directories) PATH... into the target index '
+                        'FILE.')
+    parser.add_argument('--stages', metavar='NAME,...',
+                        help='The stages for pandoc-fignos-chain (default '
+                        'fignos).')
+    parser.add_argument('--batch', action='store_true',
+                        help='Filter the json files in IN_DIR into OUT_DIR.')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='The number of batch or parallel processes.')
+    parser.add_argument('dirs', nargs='*', metavar='IN_DIR OUT_DIR',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    if args.collect:
+        if len(args.dirs) < 2:
+            parser.error('--collect requires FILE and PATH...')
+    elif len(args.dirs) != (2 if args.batch else 0):
+        parser.error('--batch requires IN_DIR and OUT_DIR' if args.batch
+                     else 'unrecognized arguments: ' + ' '.join(args.dirs))
+    return args
+
+# pylint: disable=unused-argument
+def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
+    """Filters the document AST."""
+    args = parse_args()
+    if args.collect:
+        collect_targets(args.fmt, args.dirs[0], args.dirs[1:],
+                        args.pandocversion)
+        return
+    if args.batch:
+        if filter_batch(args.fmt, args.dirs[0], args.dirs[1],
+                        args.pandocversion, args.verbose, args.jobs,
+                        args.cache, args.cache_size, args.index):
+            sys.exit(1)
+        return
+    profile = Profile(args.cprofile) if args.profile or args.cprofile \
+      else None
+    cache = BlockCache(args.cache, args.cache_size) if args.cache else None
+    index = TargetIndex(args.index) if args.index else None
+    manifest = Manifest() if args.manifest else None
+    filter_document(stdin, stdout, args.fmt, args.pandocversion,
+                    args.verbose, args.stream, profile, cache, index,
+                    args.jobs or 0 if args.parallel else None, manifest,
+                    args.patch)
+    if manifest:
+        manifest.save(args.manifest)
+    if profile:
+        profile.write(args.profile or '-', format=args.fmt,
+                      pandocversion=args.pandocversion, stream=args.stream,
+                      parallel=args.parallel)
+
+# pylint: disable=too-many-arguments
+def filter_document(stdin, stdout, fmt, pandocversion=None, verbose=False,
+                    stream=False, profile=None, cache=None, index=None,
+                    jobs=None, manifest=None, patch=False):
+    """Filters the document read from `stdin` for the output format `fmt`
+    and writes it to `stdout`.  The stages are recorded in the Profile
+    `profile`, filtered blocks are reused from the BlockCache `cache`,
+    references to other chapters are resolved using the TargetIndex
+    `index`, the sections are filtered in parallel by `jobs` processes
+    (0 for one per CPU), and the figures and references are recorded in the
+    Manifest `manifest`, if these are given.  The cache and parallel modes
+    are not used when streaming.
+
+    If `patch` is True, a json patch from make_patch() that changes the
+    input into the filtered document is written instead of the document.
+    The document is not streamed in this case.
+
+    Text streams are read and written through their binary buffers, if
+    they have them, and the json is decoded and encoded by the codec from
+    get_codec().
+    """
+
+    fignos = FignosFilter(verbose, profile, index, manifest)
+    profile = fignos.profile
+    codec = get_codec()
+
+    # Get the document
+    if stream and not patch:
+        reader = JSONReader(stdin)
+        if reader.peek() == '{':  # pandoc >= 1.18
+            fignos.filter_stream(reader, stdout, fmt, pandocversion)
+            return
+        text = reader.read()  # Older documents are filtered in memory
     else:
-        doc = doc[:1] + altered
+        with profile.stage('read'):
+            text = getattr(stdin, 'buffer', stdin).read()
+
+    # Plan the passes.  Pass the document through without decoding it if
+    # there is nothing to do, but only if it looks like a whole document.
+    with profile.stage('plan'):
+        plan = plan_passes(text)
+        if plan['passthrough']:
+            check_document(text)
+    if plan['passthrough']:
+        if verbose:
+            report_plan(plan, False)
+        with profile.stage('write'):
+            write_json(stdout, b'[]' if patch else text)
+            stdout.flush()
+        return
+    with profile.stage('decode'):
+        doc = codec.loads(text)
+    del text
+    if patch:
+        with profile.stage('snapshot'):
+            snap = snapshot(doc)
+
+    # Filter the doc
+    doc = fignos.filter(doc, fmt, pandocversion, plan, cache, jobs)
 
     # Dump the results
-    json.dump(doc, stdout)
+    with profile.stage('encode'):
+        write_json(stdout, codec.dumps(make_patch(snap, doc) if patch
+                                       else doc))
 
     # Flush stdout
     stdout.flush()
 
+# pylint: disable=too-many-arguments
+def _filter_captured(stdin, stdout, fmt, pandocversion=None, verbose=False,
+                     stream=False, cache=None, index=None, manifest=None,
+                     patch=False):
+    """Calls filter_document() and captures the messages written to
+    stderr.  This is only for worker processes that filter one document at
+    a time.  The BlockCache `cache`, TargetIndex `index` and Manifest
+    `manifest` are used if they are given.  A patch is written instead of
+    the document if `patch` is True.  Returns the exit status (0, or 1 if
+    there was an error) and the messages."""
+    with _capture_messages() as buf:
+        try:
+            filter_document(stdin, stdout, fmt, pandocversion, verbose, stream,
+                            cache=cache, index=index, manifest=manifest,
+                            patch=patch)
+            status = 0
+        except Exception:  # pylint: disable=broad-except
+            import traceback
+            buf.write(traceback.format_exc())
+            status = 1
+    return status, buf.getvalue()
+
+
+# Batch ----------------------------------------------------------------------
+
+# pylint: disable=too-many-arguments
+def _filter_file(inpath, outpath, fmt, pandocversion, verbose, cache=None,
+                 cache_size=CACHE_SIZE, index=None, chapter=None):
+    """Filters the json file `inpath` into `outpath` in a batch worker.
+    The block cache in the directory `cache` and the TargetIndex `index`
+    (for the chapter named `chapter`) are used if they are given.  Returns
+    the exit status, the elapsed time and the messages."""
+    import copy
+    start = time.time()
+    outdir = os.path.dirname(outpath)
+    if outdir and not os.path.isdir(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError:  # Another worker may have made it
+            if not os.path.isdir(outdir):
+                raise
+    if index is not None:
+        index = copy.copy(index)
+        index.chapter = chapter
+    with io.open(inpath, encoding='utf-8') as stdin, \
+      io.open(outpath, 'w', encoding='utf-8') as stdout:
+        status, messages = _filter_captured(
+            stdin, stdout, fmt, pandocversion, verbose,
+            cache=BlockCache(cache, cache_size) if cache else None,
+            index=index)
+    if status:  # Don't leave incomplete output behind
+        os.remove(outpath)
+    return status, time.time() - start, messages
+
+def find_documents(indir):
+    """Returns the paths of the json files under `indir`, relative to it."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(indir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.json'):
+                paths.append(os.path.relpath(os.path.join(dirpath, filename),
+                                             indir))
+    return paths
+
+# pylint: disable=too-many-arguments,too-many-locals
+def filter_batch(fmt, indir, outdir, pandocversion=None, verbose=False,
+                 jobs=None, cache=None, cache_size=CACHE_SIZE, index=None):
+    """Filters the json files under `indir` into the same paths under
+    `outdir`, using a pool of `jobs` processes.  The block cache in the
+    directory `cache` is shared by the processes if one is given.  If the
+    target index file `index` is given, each file is filtered as the
+    chapter named by its path (see chapter_name()).  The timing and any
+    messages for each file are reported to stderr.  Returns the number of
+    files that failed."""
+
+    paths = find_documents(indir)
+    start = time.time()
+    index = TargetIndex(index) if index else None
+
+    def report(path, status, elapsed, messages):
+        """Reports the result for a file."""
+        STDERR.write('pandoc-fignos: %s %s (%.3fs)\n' % \
+                     ('Failed' if status else 'Filtered', path, elapsed))
+        if messages:
+            STDERR.write('\n'.join('    ' + line for line in
+                                   messages.split('\n') if line))
+            STDERR.write('\n')
+        STDERR.flush()
+
+    failures = 0
+    try:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+    except ImportError:  # Python 2 without the futures backport
+        for path in paths:
+            result = _filter_file(os.path.join(indir, path),
+                                  os.path.join(outdir, path), fmt,
+                                  pandocversion, verbose, cache, cache_size,
+                                  index, chapter_name(path))
+            report(path, *result)
+            failures += bool(result[0])
+    else:
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = dict((executor.submit(_filter_file,
+                                            os.path.join(indir, path),
+                                            os.path.join(outdir, path), fmt,
+                                            pandocversion, verbose, cache,
+                                            cache_size, index,
+                                            chapter_name(path)), path)
+                           for path in paths)
+            for future in as_completed(futures):
+                result = future.result()
+                report(futures[future], *result)
+                failures += bool(result[0])
+
+    STDERR.write('pandoc-fignos: Filtered %d files (%d failed) in %.3fs.\n' \
+                 % (len(paths), failures, time.time() - start))
+    STDERR.flush()
+    return failures
+
+def collect_targets(fmt, indexpath, paths, pandocversion=None):
+    """Collects the figure targets in the chapters of a book into the
+    target index file at `indexpath`.  The chapters are the json files at
+    `paths`, in book order; a directory stands for the json files under
+    it, in sorted order.  Chapters are named by their paths relative to the
+    directory given (or by their file names)."""
+
+    def chapters():
+        """Yields the (name, doc) pairs for the chapters."""
+        for path in paths:
+            if os.path.isdir(path):
+                names = [(chapter_name(relpath), os.path.join(path, relpath))
+                         for relpath in find_documents(path)]
+            else:
+                names = [(chapter_name(os.path.basename(path)), path)]
+            for name, filepath in names:
+                with io.open(filepath, encoding='utf-8') as f:
+                    yield name, json.load(f)
+
+    start = time.time()
+    index = FignosFilter().collect(chapters(), fmt, pandocversion)
+    index.save(indexpath)
+    STDERR.write('pandoc-fignos: Collected %d targets from %d chapters in '
+                 '%.3fs.\n' % (len(index.targets), len(index.chapters),
+                               time.time() - start))
+    STDERR.flush()
+
+
+# Chain ----------------------------------------------------------------------
+
+# Stage factories for run_chain(), by name; see register_stage()
+STAGES = {}
+
+def register_stage(name, factory):
+    """Registers a stage for run_chain() under `name`.  `factory()` must
+    return a callable stage(doc, fmt, pandocversion) that filters the
+    decoded document AST `doc` for the output format `fmt` and returns it.
+    A stage is made for each document.  pandocxnos is initialized for the
+    document before the stages are run, and `pandocversion` is the version
+    that it was initialized for."""
+    STAGES[name] = factory
+
+def get_stage(name):
+    """Returns the stage factory registered as `name`.  A name of the form
+    'module:factory' is imported and registered if it is not already."""
+    if name not in STAGES and ':' in name:
+        import importlib
+        modname, attr = name.split(':', 1)
+        register_stage(name, getattr(importlib.import_module(modname), attr))
+    if name not in STAGES:
+        raise KeyError('Unknown stage: %s' % name)
+    return STAGES[name]
+
+def _fignos_stage():
+    """Returns the pandoc-fignos stage.  It does not initialize pandocxnos
+    again, since run_chain() has."""
+    fignos = FignosFilter()
+    def stage(doc, fmt, pandocversion):
+        """Filters the document AST `doc`."""
+        return fignos.filter(doc, fmt, pandocversion, initialized=True)
+    return stage
+
+register_stage('fignos', _fignos_stage)
+
+def run_chain(doc, fmt, names, pandocversion=None, profile=None):
+    """Runs the stages registered as `names` over the document AST `doc`
+    in order, for the output format `fmt`.  Returns the filtered doc.  The
+    pandoc version is determined once and is given to each stage.  The
+    stages are timed in the Profile `profile`, if one is given."""
+    profile = profile or Profile()
+    factories = [get_stage(name) for name in names]
+    with _XNOS_LOCK:
+        with profile.stage('init'):
+            pandocversion = init_pandocxnos(pandocversion, doc)
+        for name, factory in zip(names, factories):
+            with profile.stage(name):
+                doc = factory()(doc, fmt, pandocversion)
+    return doc
+
+# pylint: disable=unused-argument
+def chain(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
+    """Filters the document AST with a chain of stages, decoding and
+    encoding it only once.  The stages are named by the --stages option or
+    the FIGNOS_STAGES environment variable (see parse_args())."""
+    args = parse_args()
+    profile = Profile(args.cprofile) if args.profile or args.cprofile \
+      else None
+    chain_document(stdin, stdout, args.fmt, args.stages, args.pandocversion,
+                   profile)
+    if profile:
+        profile.write(args.profile or '-', format=args.fmt,
+                      pandocversion=args.pandocversion, stages=args.stages)
+
+# pylint: disable=too-many-arguments
+def chain_document(stdin, stdout, fmt, names, pandocversion=None,
+                   profile=None):
+    """Filters the document read from `stdin` with the stages registered
+    as `names` (see run_chain()), and writes it to `stdout`."""
+    profile = profile or Profile()
+    codec = get_codec()
+    with profile.stage('read'):
+        text = getattr(stdin, 'buffer', stdin).read()
+    with profile.stage('decode'):
+        doc = codec.loads(text)
+    del text
+    doc = run_chain(doc, fmt, names, pandocversion, profile)
+    with profile.stage('encode'):
+        write_json(stdout, codec.dumps(doc))
+    stdout.flush()
+
+
+# Server ---------------------------------------------------------------------
+
+# Environment variables forwarded from clients to the server
+FORWARDED_ENV = ['PANDOC_VERSION', 'FIGNOS_VERBOSE', 'FIGNOS_STREAM',
+                 'FIGNOS_CODEC', 'FIGNOS_VERSION_CACHE']
+
+def socket_path():
+    """Returns the path of the server's unix socket.  This may be set with
+    the FIGNOS_SOCKET environment variable.  Otherwise the socket is put in
+    XDG_RUNTIME_DIR or, since the temporary directory is shared, in a
+    private directory under it."""
+    if 'FIGNOS_SOCKET' in os.environ:
+        return os.environ['FIGNOS_SOCKET']
+    if 'XDG_RUNTIME_DIR' in os.environ:
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'],
+                            'pandoc-fignos-%d.sock' % os.getuid())
+    import tempfile
+    return os.path.join(tempfile.gettempdir(),
+                        'pandoc-fignos-%d' % os.getuid(), 'server.sock')
+
+def _check_socket_dir(path):
+    """Makes the directory for the socket `path` (private to this user) if
+    it does not exist.  Returns an error message if other users could
+    replace the socket, or None."""
+    import stat
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+    st = os.stat(dirname)
+    if not st.st_mode & stat.S_ISVTX and \
+      (st.st_uid != os.getuid() or st.st_mode & 0o022):
+        return '%s may be written by other users' % dirname
+    if os.path.lexists(path) and os.lstat(path).st_uid != os.getuid():
+        return '%s belongs to another user' % path
+    return None
+
+def _peer_uid(sock):
+    """Returns the user id of the process at the other end of the unix
+    socket `sock`, or None if it can't be found."""
+    import socket
+    import struct
+    if not hasattr(socket, 'SO_PEERCRED'):  # Linux only
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+def _within(path, dirname):
+    """Returns True if `path` is `dirname` or is under it."""
+    path, dirname = os.path.realpath(path), os.path.realpath(dirname)
+    return path == dirname or path.startswith(os.path.join(dirname, ''))
+
+def _recvall(sock):
+    """Reads `sock` until the peer stops sending.  Returns the header dict
+    and the body bytes."""
+    chunks = []
+    while True:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    header, _, body = b''.join(chunks).partition(b'\n')
+    return json.loads(header.decode('utf-8')), body
+
+def _sendall(sock, header, body):
+    """Sends the `header` dict and `body` bytes over `sock`, and then stops
+    sending."""
+    import socket
+    sock.sendall(json.dumps(header).encode('utf-8') + b'\n' + body)
+    sock.shutdown(socket.SHUT_WR)
+
+def _serve_request(request, text):
+    """Filters `text` in a server worker.  Returns the exit status, output,
+    messages and manifest data (or None).
+
+    Parameters:
+
+      request - a dict with the fmt, pandocversion, verbose, stream,
+                cache, cache_size, patch and manifest settings, the index
+                data (or None), the client's working directory and the
+                client's environment
+      text - the document json
+
+    The server only writes to the cache, which must be under the client's
+    working directory.  The index and manifest files are read and written
+    by the client.
+    """
+    cache = request['cache']
+    if cache and not _within(cache, request['cwd']):
+        return 1, '', 'pandoc-fignos: The cache directory %s is not under ' \
+          'the working directory.\n' % cache, None
+    for name in FORWARDED_ENV:
+        os.environ.pop(name, None)
+    os.environ.update(request['env'])
+    stdout = io.StringIO()
+    manifest = Manifest() if request['manifest'] else None
+    status, messages = _filter_captured(
+        io.StringIO(text), stdout, request['fmt'], request['pandocversion'],
+        request['verbose'], request['stream'],
+        cache=BlockCache(cache, request['cache_size']) if cache else None,
+        index=TargetIndex(data=request['index']) if request['index'] \
+          else None,
+        manifest=manifest, patch=request['patch'])
+    return status, stdout.getvalue(), messages, \
+      manifest.data() if manifest and not status else None
+
+def serve(path=None, workers=None):
+    """Runs the filter server on the unix socket at `path` with a pool of
+    `workers` processes.  Only this user may connect."""
+
+    # pylint: disable=import-error
+    import argparse
+    import multiprocessing
+    import socket
+    if sys.version_info > (3,):
+        import socketserver
+    else:
+        import SocketServer as socketserver
+
+    if not hasattr(socket, 'AF_UNIX'):
+        STDERR.write('pandoc-fignos: The server requires unix sockets.\n')
+        sys.exit(1)
+
+    if path is None:
+        parser = argparse.ArgumentParser(\
+          description='Pandoc figure numbers filter server.')
+        parser.add_argument('--socket', default=socket_path(),
+                            help='The unix socket path.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='The number of worker processes.')
+        args = parser.parse_args()
+        path, workers = args.socket, args.workers
+
+    msg = _check_socket_dir(path)
+    if msg:
+        STDERR.write('pandoc-fignos: Not serving; %s.\n' % msg)
+        sys.exit(1)
+
+    # Fork the workers so that they start with the imports done
+    context = multiprocessing.get_context('fork') \
+      if hasattr(multiprocessing, 'get_context') else multiprocessing
+    pool = context.Pool(workers)
+
+    class Handler(socketserver.BaseRequestHandler):
+        """Filters a document sent by a client."""
+        def handle(self):
+            if _peer_uid(self.request) not in (None, os.getuid()):
+                return
+            request, body = _recvall(self.request)
+            status, output, messages, manifest = \
+              pool.apply(_serve_request, (request, body.decode('utf-8')))
+            _sendall(self.request, {'status': status, 'stderr': messages,
+                                    'manifest': manifest},
+                     output.encode('utf-8'))
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    os.chmod(path, 0o600)
+    server.daemon_threads = True
+    STDERR.write('pandoc-fignos: Serving on %s\n' % path)
+    STDERR.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        pool.terminate()
+
+def _connect(path):
+    """Connects to the server at the socket `path`.  Returns the socket, or
+    None if there is no server or it is run by another user."""
+    import socket
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    except (AttributeError, socket.error):
+        return None
+    uid = _peer_uid(sock)
+    if (os.stat(path).st_uid if uid is None else uid) != os.getuid():
+        sock.close()
+        STDERR.write('pandoc-fignos: Ignoring the server on %s, which is '
+                     'run by another user.\n' % path)
+        STDERR.flush()
+        return None
+    return sock
+
+def client(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
+    """Filters the document AST using the server, if one is running.
+    Otherwise the document is filtered in this process, as it is for
+    batches, profiles, parallel filtering and caches outside of the
+    working directory."""
+
+    args = parse_args()
+    if args.batch or args.collect:  # Batches are always done here
+        main()
+        return
+
+    sock = _connect(socket_path())
+    if sock is not None:
+        reason = 'profiling' if args.profile or args.cprofile else \
+          'parallel filtering' if args.parallel else \
+          'a cache outside of the working directory' \
+            if args.cache and not _within(args.cache, os.getcwd()) else None
+        if reason:
+            sock.close()
+            sock = None
+            STDERR.write('pandoc-fignos: The server does not do %s; '
+                         'filtering in this process.\n' % reason)
+            STDERR.flush()
+    if sock is None:  # Filter it here
+        main(stdin, stdout, stderr)
+        return
+
+    env = dict((name, os.environ[name]) for name in FORWARDED_ENV
+               if name in os.environ)
+    if env.get('FIGNOS_VERSION_CACHE'):  # Relative to this directory
+        env['FIGNOS_VERSION_CACHE'] = \
+          os.path.abspath(env['FIGNOS_VERSION_CACHE'])
+    request = {'fmt': args.fmt, 'pandocversion': args.pandocversion,
+               'verbose': args.verbose, 'stream': args.stream,
+               'cwd': os.getcwd(),
+               'cache': os.path.abspath(args.cache) if args.cache else None,
+               'cache_size': args.cache_size,
+               'index': TargetIndex(args.index).data() if args.index \
+                 else None,
+               'manifest': bool(args.manifest), 'patch': args.patch,
+               'env': env}
+    _sendall(sock, request, getattr(stdin, 'buffer', stdin).read())
+    response, body = _recvall(sock)
+    sock.close()
+
+    stderr.write(response['stderr'])
+    stderr.flush()
+    out = getattr(stdout, 'buffer', stdout)
+    stdout.flush()
+    out.write(body)
+    out.flush()
+    if response['manifest'] is not None:
+        Manifest(response['manifest']).save(args.manifest)
+    if response['status']:
+        sys.exit(response['status'])
+
 if __name__ == '__main__':
     main()
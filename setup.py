@@ -51,7 +51,11 @@ setup(
     install_requires=['pandoc-xnos >= 2.5.0, < 3.0'],
 
     py_modules=['pandoc_fignos'],
-    entry_points={'console_scripts':['pandoc-fignos = pandoc_fignos:main']},
+    entry_points={'console_scripts':[
+        'pandoc-fignos = pandoc_fignos:main',
+        'pandoc-fignos-server = pandoc_fignos:serve',
+        'pandoc-fignos-client = pandoc_fignos:client',
+        'pandoc-fignos-chain = pandoc_fignos:chain']},
 
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -0,0 +1,362 @@
+#! /usr/bin/env python
+
+"""Offline benchmarks for pandoc-fignos.
+
+Synthetic pandoc json documents are generated for a selection of pandoc
+versions and output formats, and are filtered without running pandoc.
+The time taken by the whole filter and by its stages, the peak memory
+use, and the decoding and encoding times for each installed json codec are
+written as one json object per line.
+
+Usage: python benchmark.py [options]  (see --help)
+
+Results from an earlier run may be given with --compare to report the
+change in the filter time for each case.  The exit status is 1 if any
+case is slower than the tolerance allows.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+# pylint: disable=wrong-import-position
+import pandocxnos
+import pandoc_fignos
+
+
+# Document generator ---------------------------------------------------------
+
+# The pandoc api versions for pandoc versions that have them
+API_VERSIONS = {'1.18': [1, 17, 0, 4], '2.0': [1, 17, 3],
+                '2.9': [1, 20], '2.10': [1, 21], '2.11': [1, 22],
+                '3.0': [1, 23]}
+
+# Words for filler text
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet,', 'consectetur',
+         'adipiscing', 'elit.']
+
+def _vtuple(pandocversion):
+    """Returns the pandoc version as a tuple of ints."""
+    return tuple(int(n) for n in pandocversion.split('.'))
+
+# pylint: disable=too-many-arguments,too-many-locals
+def generate(pandocversion='2.11', sections=10, figures=100, divs=10,
+             tagged=10, refs=500, paragraphs=500, seed=1, duplicates=0):
+    """Returns a synthetic pandoc json document.
+
+    Parameters:
+
+      pandocversion - the pandoc version whose json is generated
+      sections - the number of sections
+      figures - the number of figures (including tagged figures)
+      divs - the number of Div figures
+      tagged - the number of tagged figures
+      refs - the number of figure references
+      paragraphs - the number of paragraphs of filler text
+      seed - the random seed
+      duplicates - the number of unreferenceable figures that have the
+                   same tag, at the end of the document
+    """
+    rand = random.Random(seed)
+    v = _vtuple(pandocversion)
+
+    def words(n):
+        """Returns n words of filler text."""
+        els = []
+        for i in range(n):
+            if i:
+                els.append({'t': 'Space'})
+            els.append({'t': 'Str', 'c': rand.choice(WORDS)})
+        return els
+
+    def image(label, kvs):
+        """Returns the inline elements for a figure image."""
+        caption = words(rand.randint(2, 8))
+        target = ['img/%s.png' % label.replace(':', '-'), 'fig:']
+        if v < (1, 16):  # The attributes follow the image
+            attrs = ' '.join(['#' + label] + ['%s=%s' % kv for kv in kvs])
+            return [{'t': 'Image', 'c': [caption, target]},
+                    {'t': 'Str', 'c': '{%s}' % attrs}]
+        return [{'t': 'Image',
+                 'c': [[label, [], [list(kv) for kv in kvs]], caption,
+                       target]}]
+
+    def figure(label, kvs):
+        """Returns the block for a figure.  Pandoc >= 3.0 gives the id to a
+        Figure block and leaves the other attributes with the image."""
+        if v < (3, 0):
+            return {'t': 'Para', 'c': image(label, kvs)}
+        caption = words(rand.randint(2, 8))
+        target = ['img/%s.png' % label.replace(':', '-'), '']
+        image_ = {'t': 'Image',
+                  'c': [['', [], [list(kv) for kv in kvs]],
+                        [dict(el) for el in caption], target]}
+        return {'t': 'Figure',
+                'c': [[label, [], []], [None, [{'t': 'Plain', 'c': caption}]],
+                      [{'t': 'Plain', 'c': [image_]}]]}
+
+    def cite(label):
+        """Returns a reference to `label`."""
+        mode = {'t': 'AuthorInText'} if v >= (2, 10) else \
+          {'t': 'AuthorInText', 'c': []}
+        return {'t': 'Cite',
+                'c': [[{'citationId': label, 'citationPrefix': [],
+                        'citationSuffix': [], 'citationMode': mode,
+                        'citationNoteNum': 0, 'citationHash': 0}],
+                      [{'t': 'Str', 'c': '@' + label}]]}
+
+    # Spread the figures, Div figures, references and paragraphs over the
+    # sections
+    def spread(n):
+        """Returns how many of n items go in each section."""
+        return [n // sections + (1 if i < n % sections else 0)
+                for i in range(sections)]
+
+    # All of the labels, so that references may be to later figures
+    labels = ['fig:f%d' % (i+1) for i in range(figures)] + \
+      ['fig:d%d-%d' % (sec, i) for sec, n in enumerate(spread(divs))
+       for i in range(n)]
+
+    blocks = []
+    nfig = 0
+    for sec, (nfigs, ndivs, nrefs, nparas) in \
+      enumerate(zip(spread(figures), spread(divs), spread(refs),
+                    spread(paragraphs))):
+        blocks.append({'t': 'Header',
+                       'c': [1, ['sec-%d' % sec, [], []],
+                             words(2)]})
+        for _ in range(nfigs):
+            nfig += 1
+            label = 'fig:f%d' % nfig
+            kvs = [('tag', 'A.%d' % nfig)] if nfig <= tagged else \
+              [('width', '50%')]
+            blocks.append(figure(label, kvs))
+        for i in range(ndivs):
+            label = 'fig:d%d-%d' % (sec, i)
+            blocks.append({'t': 'Div',
+                           'c': [[label, [], []],
+                                 [figure('fig:', [])]]})
+        for i in range(nparas):
+            para = words(rand.randint(10, 40))
+            if i < nrefs:
+                para += [{'t': 'Space'}, cite(rand.choice(labels))] \
+                  if labels else []
+            blocks.append({'t': 'Para', 'c': para})
+        for _ in range(nrefs - nparas):  # Any references left over
+            blocks.append({'t': 'Para',
+                           'c': words(3) + [{'t': 'Space'},
+                                            cite(rand.choice(labels))]})
+    for _ in range(duplicates):
+        blocks.append(figure('fig:', [('tag', 'B')]))
+
+    if v >= (1, 18):
+        return {'pandoc-api-version': API_VERSIONS[
+            max(key for key in API_VERSIONS if _vtuple(key) <= v)],
+                'meta': {}, 'blocks': blocks}
+    return [{'unMeta': {}}, blocks]
+
+
+# Timing ---------------------------------------------------------------------
+
+class StageTimer(pandoc_fignos.FignosFilter):
+    """A FignosFilter that records the time spent in its stages."""
+
+    # The methods that are timed
+    STAGES = ['process', '_process_figure', '_adjust_caption', '_add_markup']
+
+    def __init__(self):
+        """Wraps the stage methods with timers."""
+        self.times = {}
+        super(StageTimer, self).__init__()
+        for name in self.STAGES:
+            setattr(self, name, self._timed(name, getattr(self, name)))
+
+    def _timed(self, name, f):
+        """Returns f wrapped so that its time is added to times[name]."""
+        self.times[name] = 0.
+        def timed(*args, **kwargs):
+            """Times f."""
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.times[name] += time.perf_counter() - start
+        return timed
+
+    def make_first_pass(self, process_figures=None):
+        """Returns the timed first_pass action."""
+        return self._timed('first_pass', super(StageTimer, self)
+                           .make_first_pass(process_figures))
+
+    def make_second_pass(self, labels=None):
+        """Returns the timed second_pass and post actions.  Together these
+        make up the reference pass."""
+        second_pass, post = super(StageTimer, self).make_second_pass(labels)
+        self.times['references'] = 0.
+        return self._timed('references', second_pass), \
+          self._timed('references', post)
+
+def codecs():
+    """Returns the installed json codecs."""
+    ret = []
+    for codec in pandoc_fignos.CODECS:
+        try:
+            ret.append(codec())
+        except ImportError:
+            pass
+    return ret
+
+def _quiet():
+    """Sends the filter's messages to a buffer."""
+    pandoc_fignos.STDERR = pandocxnos.core.STDERR = io.StringIO()
+
+def run_case(text, fmt, pandocversion, repeat):
+    """Benchmarks filtering the json `text`.  Returns a dict of results.
+    The fastest of `repeat` runs is taken for each time."""
+
+    _quiet()
+    result = {'bytes': len(text)}
+
+    # Time the filter as a whole
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pandoc_fignos.filter_document(io.StringIO(text), io.StringIO(), fmt,
+                                      pandocversion)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result['main'] = best
+
+    # Time the stages
+    stages = {}
+    for _ in range(repeat):
+        times = {}
+        start = time.perf_counter()
+        doc = json.loads(text)
+        times['decode'] = time.perf_counter() - start
+        fignos = StageTimer()
+        start = time.perf_counter()
+        fignos.filter(doc, fmt, pandocversion)
+        times['filter'] = time.perf_counter() - start
+        start = time.perf_counter()
+        json.dumps(doc)
+        times['encode'] = time.perf_counter() - start
+        times.update(fignos.times)
+        for key, value in times.items():
+            stages[key] = min(stages.get(key, value), value)
+    result['stages'] = stages
+
+    # Measure the peak memory
+    tracemalloc.start()
+    pandoc_fignos.filter_document(io.StringIO(text), io.StringIO(), fmt,
+                                  pandocversion)
+    result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # Compare the json codecs.  Their output must be the same.
+    data = text.encode('utf-8')
+    result['codecs'] = {}
+    outputs = set()
+    for codec in codecs():
+        times = {}
+        for _ in range(repeat):
+            start = time.perf_counter()
+            doc = codec.loads(data)
+            elapsed = time.perf_counter() - start
+            times['decode'] = min(times.get('decode', elapsed), elapsed)
+            start = time.perf_counter()
+            output = codec.dumps(doc)
+            elapsed = time.perf_counter() - start
+            times['encode'] = min(times.get('encode', elapsed), elapsed)
+        outputs.add(output)
+        result['codecs'][codec.name] = times
+    result['codecs_identical'] = len(outputs) == 1
+
+    return result
+
+
+# Main program ---------------------------------------------------------------
+
+def compare(results, path, tolerance):
+    """Compares the `results` with those in the file at `path`.  Returns
+    True if no case is slower than the tolerance allows."""
+    with io.open(path, encoding='utf-8') as f:
+        old = dict((r['case'], r) for r in (json.loads(line) for line in f
+                                            if line.strip()))
+    ok = True
+    for result in results:
+        if result['case'] not in old:
+            continue
+        ratio = result['main'] / old[result['case']]['main']
+        slower = ratio > 1 + tolerance
+        ok = ok and not slower
+        sys.stderr.write('%-24s %6.3fs -> %6.3fs (%+.0f%%)%s\n' % \
+                         (result['case'], old[result['case']]['main'],
+                          result['main'], 100*(ratio-1),
+                          '  SLOWER' if slower else ''))
+    return ok
+
+def main():
+    """Runs the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--versions', default='1.15,1.17,2.9,2.11,3.0',
+                        help='Comma-separated pandoc versions.')
+    parser.add_argument('--formats', default='latex,html,docx',
+                        help='Comma-separated output formats.')
+    parser.add_argument('--sections', type=int, default=10)
+    parser.add_argument('--figures', type=int, default=100)
+    parser.add_argument('--divs', type=int, default=10)
+    parser.add_argument('--tagged', type=int, default=10)
+    parser.add_argument('--refs', type=int, default=500)
+    parser.add_argument('--paragraphs', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per case; the fastest is reported.')
+    parser.add_argument('--output', help='Write the results to a file.')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare with results from an earlier run.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='The allowed fractional slowdown.')
+    parser.add_argument('--generate', action='store_true',
+                        help='Write one document to stdout and exit.')
+    args = parser.parse_args()
+
+    size = dict((name, getattr(args, name)) for name in
+                ['sections', 'figures', 'divs', 'tagged', 'refs',
+                 'paragraphs', 'seed'])
+    versions = args.versions.split(',')
+    formats = args.formats.split(',')
+
+    if args.generate:
+        json.dump(generate(versions[0], **size), sys.stdout)
+        return
+
+    results = []
+    out = io.open(args.output, 'w', encoding='utf-8') if args.output \
+      else sys.stdout
+    for pandocversion in versions:
+        text = json.dumps(generate(pandocversion, **size))
+        for fmt in formats:
+            result = {'case': '%s/%s' % (pandocversion, fmt),
+                      'pandocversion': pandocversion, 'format': fmt,
+                      'size': size}
+            result.update(run_case(text, fmt, pandocversion, args.repeat))
+            results.append(result)
+            out.write(u'%s\n' % json.dumps(result, sort_keys=True))
+            out.flush()
+    if args.output:
+        out.close()
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+
+"""Patch test for pandoc-fignos.
+
+Synthetic documents (see benchmark.py) are filtered for a selection of
+pandoc versions, output formats and filter modes, both as usual and with
+--patch.  The test fails if applying the patch to the input does not give
+the filtered document.  The sizes of the patches and documents are
+reported.
+
+Usage: python patches.py [--versions V,...] [--formats F,...]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# The root of the source tree
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+import pandoc_fignos
+from benchmark import generate
+
+def run(text, fmt, pandocversion, args):
+    """Filters the json `text` with the extra command-line `args`.  Returns
+    the output."""
+    proc = subprocess.Popen([sys.executable,
+                             os.path.join(ROOT, 'pandoc_fignos.py'), fmt,
+                             '--pandocversion=' + pandocversion] + args,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, _ = proc.communicate(text.encode('utf-8'))
+    if proc.returncode:
+        sys.stderr.write('patches: the filter failed\n')
+        sys.exit(1)
+    return out
+
+def main():
+    """Runs the test."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--versions', default='1.15,2.11,3.0',
+                        help='Comma-separated pandoc versions.')
+    parser.add_argument('--formats', default='latex,html,epub3,docx',
+                        help='Comma-separated output formats.')
+    args = parser.parse_args()
+
+    cachedir = tempfile.mkdtemp()
+    modes = [[], ['--parallel', '--jobs', '2'], ['--cache', cachedir]]
+    failed = []
+    results = []
+    try:
+        for pandocversion in args.versions.split(','):
+            text = json.dumps(generate(pandocversion, sections=5, figures=20,
+                                       divs=5, tagged=5, refs=50,
+                                       paragraphs=100))
+            for fmt in args.formats.split(','):
+                for mode in modes:
+                    case = ' '.join([pandocversion, fmt] + mode[:1])
+                    out = run(text, fmt, pandocversion, mode)
+                    patch = run(text, fmt, pandocversion, mode + ['--patch'])
+                    doc = pandoc_fignos.apply_patch(json.loads(text),
+                                                    json.loads(patch))
+                    if doc != json.loads(out):
+                        failed.append(case)
+                        sys.stderr.write('patches: %s differs\n' % case)
+                    results.append({'case': case, 'document': len(out),
+                                    'patch': len(patch),
+                                    'operations': len(json.loads(patch))})
+    finally:
+        shutil.rmtree(cachedir)
+
+    for result in results:
+        print(json.dumps(result, sort_keys=True))
+    print(json.dumps({'cases': len(results), 'failed': failed}))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+
+"""Python 2 test for pandoc-fignos.
+
+Synthetic documents (see benchmark.py) are filtered for a selection of
+pandoc versions, output formats and filter modes, and as a batch, both
+with Python 2.7 and with the python running this test.  The cache, target
+index and manifest files are used as well.  The test fails if the filter
+fails with either interpreter, or if the decoded outputs or files differ.
+
+Usage: python python2.py [--python PYTHON] [--versions V,...]
+                         [--formats F,...]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmark import generate
+
+# The root of the source tree
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# The filter modes, as extra command-line arguments.  DIR stands for a
+# directory of files that are compared after the run.  Batches filter a
+# directory of documents into DIR/out.
+MODES = [[], ['--stream'], ['--parallel', '--jobs', '2'],
+         ['--cache', 'DIR/cache'], ['--manifest', 'DIR/manifest.json'],
+         ['--manifest', 'DIR/manifest.csv'], ['--batch'],
+         ['--batch', '--cache', 'DIR/cache', '--index', 'DIR/index.json']]
+
+def read(dirname):
+    """Returns the contents of the files under `dirname` by relative path.
+    Json files are decoded, and cache entries are skipped."""
+    contents = {}
+    for dirpath, dirnames, filenames in os.walk(dirname):
+        if 'cache' in dirnames:
+            dirnames.remove('cache')
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                data = f.read().decode('utf-8')
+            contents[os.path.relpath(path, dirname)] = \
+              json.loads(data) if filename.endswith('.json') \
+              else data.splitlines()
+    return contents
+
+def run(python, text, fmt, pandocversion, mode, indir, dirname):
+    """Filters the json `text` (or the documents in `indir`, for a batch)
+    with the interpreter `python`, using the directory `dirname` for files.
+    Returns the decoded output and the files, or None if the filter
+    failed."""
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.mkdir(dirname)
+    mode = [arg.replace('DIR', dirname) for arg in mode]
+    cmd = [python, os.path.join(ROOT, 'pandoc_fignos.py'), fmt,
+           '--pandocversion=' + pandocversion]
+    if '--batch' in mode:
+        cmd[2:3] = ['--batch', fmt, indir, os.path.join(dirname, 'out')]
+        mode.remove('--batch')
+    outputs = []
+    if '--index' in mode:  # Collect the targets first
+        outputs.append(run_cmd([python,
+                                os.path.join(ROOT, 'pandoc_fignos.py'),
+                                '--collect', fmt,
+                                mode[mode.index('--index')+1], indir,
+                                '--pandocversion=' + pandocversion]))
+    if '--cache' in mode:  # Run once more to use the cached blocks
+        outputs.append(run_cmd(cmd + mode, text))
+    outputs.append(run_cmd(cmd + mode, text))
+    if None in outputs:
+        return None
+    return [json.loads(out.decode('utf-8')) if out else None
+            for out in outputs], read(dirname)
+
+def run_cmd(cmd, text=None):
+    """Runs the command `cmd` with the json `text` as input.  Returns the
+    output, or None if the command failed."""
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(text.encode('utf-8') if text else b'')
+    if proc.returncode:
+        sys.stderr.write(err.decode('utf-8', 'replace'))
+        return None
+    return out
+
+def main():
+    """Runs the test."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--python', default='python2.7',
+                        help='The Python 2 interpreter.')
+    parser.add_argument('--versions', default='1.15,2.11,3.0',
+                        help='Comma-separated pandoc versions.')
+    parser.add_argument('--formats', default='latex,html,epub3,docx',
+                        help='Comma-separated output formats.')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    indir = os.path.join(tmpdir, 'in')
+    failed = []
+    cases = 0
+    try:
+        for pandocversion in args.versions.split(','):
+            texts = [json.dumps(generate(pandocversion, sections=5,
+                                         figures=20, divs=5, tagged=5,
+                                         refs=50, paragraphs=20, seed=seed))
+                     for seed in (1, 2, 3)]
+            if os.path.isdir(indir):
+                shutil.rmtree(indir)
+            os.mkdir(indir)
+            for i, text in enumerate(texts):
+                with open(os.path.join(indir, 'doc-%d.json' % i), 'wb') as f:
+                    f.write(text.encode('utf-8'))
+            for fmt in args.formats.split(','):
+                for mode in MODES:
+                    case = ' '.join([pandocversion, fmt] +
+                                    [arg for arg in mode
+                                     if arg.startswith('--')])
+                    cases += 1
+                    text = None if '--batch' in mode else texts[0]
+                    out = run(args.python, text, fmt, pandocversion, mode,
+                              indir, os.path.join(tmpdir, 'py2'))
+                    if out is None or \
+                      out != run(sys.executable, text, fmt, pandocversion,
+                                 mode, indir, os.path.join(tmpdir, 'py')):
+                        failed.append(case)
+                        sys.stderr.write('python2: %s %s\n' % \
+                                         (case, 'failed' if out is None
+                                          else 'differs'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print(json.dumps({'cases': cases, 'failed': failed}))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
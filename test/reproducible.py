@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+
+"""Reproducibility test for pandoc-fignos.
+
+Synthetic documents (see benchmark.py) are filtered twice for each of a
+selection of pandoc versions, output formats and filter modes, each time
+in a new process with a different hash seed.  The test fails if any
+output differs between the runs, or if two unreferenceable figures (some
+of which have the same tag) are given the same id.
+
+Usage: python reproducible.py [--versions V,...] [--formats F,...]
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+from benchmark import generate
+
+# The root of the source tree
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# The filter modes, as extra command-line arguments
+MODES = [[], ['--stream'], ['--parallel', '--jobs', '2']]
+
+# Matches the ids given to unreferenceable figures
+UUID_ID = re.compile(r'fig:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                     r'[0-9a-f]{12}')
+
+def run(text, fmt, pandocversion, mode, seed):
+    """Filters the json `text` in a new process.  Returns the output."""
+    env = dict(os.environ, PYTHONHASHSEED=str(seed))
+    proc = subprocess.Popen([sys.executable,
+                             os.path.join(ROOT, 'pandoc_fignos.py'), fmt,
+                             '--pandocversion=' + pandocversion] + mode,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env)
+    out, _ = proc.communicate(text.encode('utf-8'))
+    if proc.returncode:
+        sys.stderr.write('reproducible: the filter failed\n')
+        sys.exit(1)
+    return out
+
+def main():
+    """Runs the test."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--versions', default='1.15,2.11,3.0',
+                        help='Comma-separated pandoc versions.')
+    parser.add_argument('--formats', default='latex,html,epub3,docx',
+                        help='Comma-separated output formats.')
+    args = parser.parse_args()
+
+    failed = []
+    for pandocversion in args.versions.split(','):
+        # Number the figures by section so that the section numbers are
+        # tracked as well
+        doc = generate(pandocversion, sections=5, figures=20, divs=5,
+                       tagged=5, refs=50, paragraphs=20, duplicates=3)
+        meta = {'fignos-number-by-section':
+                {'t': 'MetaBool', 'c': True}}
+        if isinstance(doc, dict):
+            doc['meta'] = meta
+        else:
+            doc[0]['unMeta'] = meta
+        text = json.dumps(doc)
+        for fmt in args.formats.split(','):
+            for mode in MODES:
+                case = ' '.join([pandocversion, fmt] + mode)
+                out = run(text, fmt, pandocversion, mode, 1)
+                if out != run(text, fmt, pandocversion, mode, 2):
+                    failed.append(case)
+                    sys.stderr.write('reproducible: %s differs\n' % case)
+                ids = UUID_ID.findall(out.decode('utf-8'))
+                if len(set(ids)) != len(ids):
+                    failed.append(case)
+                    sys.stderr.write('reproducible: %s has duplicate ids\n'
+                                     % case)
+
+    print(json.dumps({'cases': len(args.versions.split(',')) *
+                               len(args.formats.split(',')) * len(MODES),
+                      'failed': failed}))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
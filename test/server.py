@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+
+"""Server test for pandoc-fignos.
+
+A filter server is started on a private socket, and synthetic documents
+(see benchmark.py) are filtered with the client and in-process, with the
+environment variables that the client forwards set in various ways.  The
+test fails if the outputs or exit statuses differ, or if the variables do
+not take effect in the server.
+
+Usage: python server.py
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark import generate
+
+# The root of the source tree
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# The filter, client and server commands
+FILTER = [sys.executable, os.path.join(ROOT, 'pandoc_fignos.py')]
+CLIENT = [sys.executable, '-c',
+          'import pandoc_fignos; pandoc_fignos.client()']
+SERVER = [sys.executable, '-c',
+          'import pandoc_fignos; pandoc_fignos.serve(%r, 1)']
+
+# The cases, as (name, environment, arguments, expected stderr substring)
+# tuples.  The version cache path is relative to the working directory.
+CASES = [
+    ('plain', {}, ['--pandocversion=1.15'], None),
+    ('json codec', {'FIGNOS_CODEC': 'json'}, ['--pandocversion=1.15'], None),
+    ('unknown codec', {'FIGNOS_CODEC': 'nonesuch'},
+     ['--pandocversion=1.15'], 'Unknown codec: nonesuch'),
+    ('after unknown codec', {}, ['--pandocversion=1.15'], None),
+    ('version cache', {'FIGNOS_VERSION_CACHE': 'versions.json'},
+     ['--verbose'], 'Pandoc version 1.15 for %s (cached)'),
+    ('no version cache', {'FIGNOS_VERSION_CACHE': ''}, ['--verbose'],
+     None)]
+
+def run(cmd, text, env, cwd):
+    """Runs the command `cmd` in `cwd` with the environment `env` and the
+    json `text` as input.  Returns the exit status, output and messages."""
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=env, cwd=cwd)
+    out, err = proc.communicate(text.encode('utf-8'))
+    return proc.returncode, out, err.decode('utf-8', 'replace')
+
+def main():
+    """Runs the test."""
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    failed = []
+    try:
+        # A pandoc that reports version 1.15, with a version cache entry
+        bindir = os.path.join(tmpdir, 'bin')
+        os.mkdir(bindir)
+        pandoc = os.path.join(bindir, 'pandoc')
+        with open(pandoc, 'w') as f:
+            f.write('#! /bin/sh\necho pandoc 1.15\n')
+        os.chmod(pandoc, 0o755)
+        st = os.stat(pandoc)
+        with open(os.path.join(tmpdir, 'versions.json'), 'w') as f:
+            json.dump({pandoc: [st.st_size, st.st_mtime, '1.15']}, f)
+
+        # The base environment; the version cache is disabled unless a
+        # case sets it
+        env = dict(os.environ)
+        for name in ['PANDOC_VERSION', 'FIGNOS_VERBOSE', 'FIGNOS_STREAM',
+                     'FIGNOS_CODEC', 'FIGNOS_VERSION_CACHE']:
+            env.pop(name, None)
+        env['PATH'] = bindir + os.pathsep + env.get('PATH', '')
+        env['PYTHONPATH'] = ROOT
+        env['FIGNOS_SOCKET'] = os.path.join(tmpdir, 'server.sock')
+        env['XDG_CACHE_HOME'] = os.path.join(tmpdir, 'cache')
+
+        # Start the server from another directory, and wait for it
+        serverdir = os.path.join(tmpdir, 'server')
+        os.mkdir(serverdir)
+        server = subprocess.Popen(
+            SERVER[:-1] + [SERVER[-1] % env['FIGNOS_SOCKET']], env=env,
+            cwd=serverdir, stderr=subprocess.PIPE)
+        for _ in range(100):
+            if os.path.exists(env['FIGNOS_SOCKET']):
+                break
+            time.sleep(0.1)
+
+        text = json.dumps(generate('1.15', sections=4, figures=12, divs=4,
+                                   tagged=2, refs=20, paragraphs=8))
+        for name, extra, args, expected in CASES:
+            caseenv = dict(env, **extra)
+            inproc = run(FILTER + ['html'] + args, text, caseenv, tmpdir)
+            served = run(CLIENT + ['html'] + args, text, caseenv, tmpdir)
+            if expected:
+                expected = expected % pandoc if '%s' in expected \
+                  else expected
+            if served[:2] != inproc[:2] or \
+              (expected and not (expected in served[2] and
+                                 expected in inproc[2])) or \
+              (not expected and served[0]):
+                failed.append(name)
+                sys.stderr.write('server: %s failed\n%s' % \
+                                 (name, served[2]))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmpdir)
+
+    print(json.dumps({'cases': len(CASES), 'failed': failed}))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
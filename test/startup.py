@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+
+"""Startup benchmark for pandoc-fignos.
+
+Measures the time taken to import pandoc_fignos and parse the arguments
+for the common `pandoc-fignos FORMAT` invocation using `python -X
+importtime`.  The time for pandoc_fignos itself (its own time and that of
+the modules it imports, excluding pandocxnos, pandocfilters and the
+modules they would import anyway) is read from each run, and the median
+is checked against a budget.  The modules that pandoc_fignos imports
+lazily are checked not to be loaded at startup.
+
+Usage: python startup.py [--budget MS] [--runs N]
+"""
+
+import argparse
+import json
+import os
+import py_compile
+import re
+import subprocess
+import sys
+
+try:
+    from statistics import median
+except ImportError:  # Python 2
+    def median(values):
+        """Returns the median of `values`."""
+        values = sorted(values)
+        mid = len(values) // 2
+        return values[mid] if len(values) % 2 else \
+          (values[mid-1] + values[mid]) / 2.
+
+# The root of the source tree
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Simulates the startup of `pandoc-fignos html`
+STARTUP = "import sys; sys.argv = ['pandoc-fignos', 'html']; " \
+          "import pandoc_fignos; pandoc_fignos.parse_args()"
+
+# Modules that pandoc_fignos only imports when they are needed
+LAZY = ['argparse', 'copy', 'multiprocessing', 'socket', 'socketserver',
+        'tempfile', 'textwrap', 'traceback', 'urllib.parse',
+        'urllib.request', 'uuid']
+
+# Dependencies whose import time is not counted against the budget
+DEPENDENCIES = ['pandocxnos', 'pandocfilters']
+
+# Matches lines of -X importtime output, giving the self and cumulative
+# times (us), the indent and the module name
+IMPORTTIME = re.compile(r'import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)')
+
+def modules(code):
+    """Returns the modules loaded after running `code`."""
+    code += '; import json; print(json.dumps(sorted(sys.modules)))'
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return set(json.loads(out.decode('utf-8')))
+
+def importtime(code, shared, module='pandoc_fignos'):
+    """Runs `code` with -X importtime.  Returns the cumulative import time
+    of `module` in ms, and its own time; i.e., the cumulative time less
+    that of the modules in `shared` that it imports."""
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=ROOT, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    lines = []  # (cumulative time, indent, name), children before parents
+    for line in err.decode('utf-8').splitlines():
+        match = IMPORTTIME.match(line)
+        if match:
+            lines.append((int(match.group(2)), len(match.group(3)),
+                          match.group(4)))
+    i = next(i for i, line in enumerate(lines) if line[2] == module)
+    total, indent, _ = lines[i]
+
+    # Walk back through the module's imports (parents before children),
+    # subtracting each shared module but not the modules it imports
+    own = total
+    skip = None  # Skips the imports of a dependency deeper than this
+    for cumulative, level, name in reversed(lines[:i]):
+        if level <= indent:  # Not imported by the module
+            break
+        if skip is not None and level > skip:
+            continue
+        skip = None
+        if name in shared:
+            own -= cumulative
+            skip = level
+    return total/1000., own/1000.
+
+def main():
+    """Runs the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--budget', type=float, default=10.,
+                        help='The budget for the own import time (ms).')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='The number of runs; the median is used.')
+    args = parser.parse_args()
+
+    # Byte-compile first so that compilation is not timed
+    py_compile.compile(os.path.join(ROOT, 'pandoc_fignos.py'), doraise=True)
+
+    # Time the imports.  The modules loaded by the dependencies are not
+    # counted, even where pandoc_fignos imports them first.
+    shared = modules('import sys, ' + ', '.join(DEPENDENCIES))
+    times = [importtime(STARTUP, shared) for _ in range(args.runs)]
+    total = median(time[0] for time in times)
+    own = median(time[1] for time in times)
+
+    # Find modules that were imported eagerly
+    loaded = modules(STARTUP) - shared
+    eager = sorted(loaded.intersection(LAZY))
+
+    print(json.dumps({'total_ms': total, 'own_ms': own,
+                      'budget_ms': args.budget, 'eager_modules': eager}))
+
+    failed = False
+    if own > args.budget:
+        sys.stderr.write('startup: %.1f ms exceeds the %.1f ms budget\n' %
+                         (own, args.budget))
+        failed = True
+    if eager:
+        sys.stderr.write('startup: imported eagerly: %s\n' % ', '.join(eager))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+
+"""Unit checks for pandoc-fignos.
+
+Functions of the filter are checked on small synthetic documents (see
+benchmark.py).  Each check that fails is reported, and the test fails if
+any do.
+
+Usage: python units.py
+"""
+
+import io
+import json
+import os
+import sys
+import traceback
+
+# The root of the source tree
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+import pandoc_fignos
+import pandocxnos
+from benchmark import generate
+
+# The checks, in the order they are run
+CHECKS = []
+
+def check(func):
+    """Registers the check `func`."""
+    CHECKS.append(func)
+    return func
+
+def blocks_of(doc):
+    """Returns the block list of the document `doc`."""
+    return doc['blocks'] if isinstance(doc, dict) else doc[1]
+
+def number_by_section(doc):
+    """Turns on fignos-number-by-section for the document `doc`."""
+    meta = {'fignos-number-by-section': {'t': 'MetaBool', 'c': True}}
+    if isinstance(doc, dict):
+        doc['meta'] = meta
+    else:
+        doc[0]['unMeta'] = meta
+
+def add_subsections(doc):
+    """Adds level 2 and 3 Headers between the blocks of the document `doc`.
+    Returns `doc`."""
+    blocks = blocks_of(doc)
+    for i in reversed(range(1, len(blocks))):
+        if i % 3 == 0:
+            level = 3 if i % 2 else 2
+            blocks.insert(i, {'t': 'Header',
+                              'c': [level, ['sub-%d' % i, [], []],
+                                    [{'t': 'Str', 'c': 'Sub'}]]})
+    return doc
+
+def run(doc, fmt='html', pandocversion='2.11', **kwargs):
+    """Filters the document `doc` (or json text) in this process.  Returns
+    the filtered document.  Keyword arguments are passed to
+    filter_document()."""
+    text = doc if isinstance(doc, str) else json.dumps(doc)
+    stdin = io.TextIOWrapper(io.BytesIO(text.encode('utf-8')),
+                             encoding='utf-8')
+    out = io.BytesIO()
+    stdout = io.TextIOWrapper(out, encoding='utf-8')
+    with pandoc_fignos._capture_messages():  # pylint: disable=protected-access
+        pandoc_fignos.filter_document(stdin, stdout, fmt, pandocversion,
+                                      **kwargs)
+    stdout.flush()
+    return json.loads(out.getvalue().decode('utf-8'))
+
+@check
+def split_sections_top_level():
+    """Chunks start only at level 1 Headers when there are subsections."""
+    blocks = blocks_of(add_subsections(generate(sections=4, figures=40,
+                                                refs=40, paragraphs=40)))
+    chunks = pandoc_fignos.split_sections(blocks, 40)
+    assert len(chunks) == 4, chunks
+    for start, _ in chunks[1:]:
+        assert blocks[start]['t'] == 'Header', blocks[start]
+        assert blocks[start]['c'][0] == 1, blocks[start]
+
+@check
+def split_sections_no_level_1():
+    """Chunks start at the top level that a document has."""
+    blocks = []
+    for i in range(8):
+        blocks.append({'t': 'Header', 'c': [2 + i % 2, ['', [], []], []]})
+        blocks.append({'t': 'Para', 'c': []})
+    chunks = pandoc_fignos.split_sections(blocks, 8)
+    assert [start for start, _ in chunks] == [0, 4, 8, 12], chunks
+
+@check
+def parallel_subsections():
+    """Documents with subsections are numbered by section the same way in
+    parallel as they are serially."""
+    for pandocversion in ['2.11', '3.0']:
+        for fmt in ['html', 'latex', 'docx']:
+            doc = add_subsections(generate(pandocversion, sections=4,
+                                           figures=20, divs=4, tagged=2,
+                                           refs=40, paragraphs=20))
+            number_by_section(doc)
+            assert run(doc, fmt, pandocversion, jobs=2) == \
+              run(doc, fmt, pandocversion), (pandocversion, fmt)
+
+@check
+def manifest_sections():
+    """The manifest gives the sections of the figures when they are not
+    numbered by section, in every mode, and without changing the output."""
+    import shutil
+    import tempfile
+    cachedir = tempfile.mkdtemp()
+    try:
+        for pandocversion in ['1.15', '2.11', '3.0']:
+            for fmt in ['html', 'latex', 'docx']:
+                doc = generate(pandocversion, sections=4, figures=12, divs=4,
+                               tagged=2, refs=20, paragraphs=8)
+                # The cache is filled without the manifest first, and is
+                # then used twice with it
+                expected = run(doc, fmt, pandocversion,
+                               cache=pandoc_fignos.BlockCache(cachedir))
+                sections = None
+                for kwargs in [{}, {'jobs': 2}, {'stream': True},
+                               {'cache': True}, {'cache': True}]:
+                    if 'cache' in kwargs:
+                        kwargs['cache'] = pandoc_fignos.BlockCache(cachedir)
+                    manifest = pandoc_fignos.Manifest()
+                    assert run(doc, fmt, pandocversion, manifest=manifest,
+                               **kwargs) == expected, (pandocversion, fmt)
+                    found = [figure['section'] for figure in manifest.figures]
+                    assert found == sorted(found), found
+                    assert found[0] == 1 and found[-1] == 4, found
+                    assert sections in (None, found), (kwargs, found)
+                    sections = found
+    finally:
+        shutil.rmtree(cachedir)
+
+@check
+def passthrough_malformed():
+    """Documents with nothing to do are passed through as they are, but
+    truncated or malformed input is an error."""
+    for pandocversion in ['1.15', '2.11']:
+        doc = generate(pandocversion, sections=2, figures=0, divs=0,
+                       tagged=0, refs=0, paragraphs=8)
+        text = json.dumps(doc)
+        assert run(doc, pandocversion=pandocversion) == doc
+        for bad in [text[:-1], text[:len(text)//2], text[1:], '', '{}']:
+            try:
+                run(bad, pandocversion=pandocversion)
+            except ValueError:
+                continue
+            raise AssertionError(bad[-20:])
+
+@check
+def chain_init_once():
+    """A chain initializes pandocxnos once, and its fignos stages give the
+    same document as the filter does."""
+    init = pandocxnos.init
+    calls = []
+    def counted(*args, **kwargs):
+        """Counts the calls to pandocxnos.init()."""
+        calls.append(args)
+        return init(*args, **kwargs)
+    pandocxnos.init = counted
+    try:
+        for pandocversion in ['1.15', '2.11', '3.0']:
+            doc = generate(pandocversion, sections=4, figures=12, divs=4,
+                           tagged=2, refs=20, paragraphs=8)
+            expected = run(doc, 'html', pandocversion)
+            del calls[:]
+            # pylint: disable=protected-access
+            with pandoc_fignos._capture_messages():
+                chained = pandoc_fignos.run_chain(doc, 'html',
+                                                  ['fignos', 'fignos'],
+                                                  pandocversion)
+            assert len(calls) == 1, calls
+            assert json.loads(json.dumps(chained)) == \
+              run(expected, 'html', pandocversion), pandocversion
+    finally:
+        pandocxnos.init = init
+
+def main():
+    """Runs the checks."""
+    failed = []
+    for func in CHECKS:
+        try:
+            func()
+        except Exception:  # pylint: disable=broad-except
+            failed.append(func.__name__)
+            sys.stderr.write('units: %s failed\n%s' % \
+                             (func.__name__, traceback.format_exc()))
+    print(json.dumps({'checks': len(CHECKS), 'failed': failed}))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()